@@ -0,0 +1,140 @@
+import getopt
+import hashlib
+import multiprocessing
+import random
+import sys
+import threading
+import time
+
+import udon.cache
+
+BENCHS = []
+def bench():
+    def _(func):
+        BENCHS.append(func)
+    return _
+
+
+def run_threads(cache, nthreads, keys):
+    def worker(keys):
+        for key in keys:
+            cache(key)
+    threads = [ threading.Thread(target = worker, args = (keys[i::nthreads], ))
+                for i in range(nthreads) ]
+    t0 = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - t0
+
+
+@bench()
+def bench_sharded():
+    """
+    Multithreaded lookups on a single-lock LRU cache, a sharded one,
+    and a CLOCK cache with lock-free hits.
+    """
+    size = 10000
+    calls = 400000
+    keys = [ int(random.paretovariate(1)) for _ in range(calls) ]
+    for nthreads in (1, 4, 16):
+        for name, cache in (("single", udon.cache.LRUCache(str, size, lock = threading.Lock())),
+                            ("sharded", udon.cache.ShardedLRUCache(str, size, shards = 16, lock = True)),
+                            ("clock", udon.cache.ClockCache(str, size, lock = threading.Lock()))):
+            dt = run_threads(cache, nthreads, keys)
+            print("%-8s threads=%-3d %.3fs %8d calls/s hit=%d miss=%d" % (
+                name, nthreads, dt, calls / dt, cache.hit, cache.miss))
+
+
+def load_trace(path):
+    with open(path) as fp:
+        return [ line.split()[0] for line in fp if line.strip() ]
+
+def zipf_trace(count, keys, alpha = 1.0):
+    weights = [ 1 / (rank ** alpha) for rank in range(1, keys + 1) ]
+    return random.choices(range(keys), weights = weights, k = count)
+
+def scan_trace(count, keys, scan_every, scan_size):
+    trace = []
+    base = keys
+    for key in zipf_trace(count, keys):
+        trace.append(key)
+        if len(trace) % scan_every == 0:
+            trace.extend(range(base, base + scan_size))
+            base += scan_size
+    return trace
+
+TRACES = []
+
+@bench()
+def bench_trace():
+    """
+    Replay key traces and compare the hit ratios of the eviction policies.
+    """
+    traces = TRACES or [ ("zipf", zipf_trace(200000, 50000)),
+                         ("zipf+scan", scan_trace(200000, 50000, 20000, 5000)) ]
+    policies = (("lru", udon.cache.LRUCache),
+                ("arc", udon.cache.ARCCache),
+                ("clock", udon.cache.ClockCache),
+                ("tinylfu", udon.cache.TinyLFUCache))
+    for name, trace in traces:
+        for size in (500, 2000, 8000):
+            for policy, factory in policies:
+                cache = factory(lambda key: key, size)
+                t0 = time.perf_counter()
+                for key in trace:
+                    cache(key)
+                dt = time.perf_counter() - t0
+                print("%-10s size=%-5d %-8s hit ratio %.3f (%.2fs)" % (
+                    name, size, policy, cache.hit / (cache.hit + cache.miss), dt))
+
+
+def expensive(key):
+    value = str(key).encode()
+    for _ in range(200):
+        value = hashlib.sha256(value).digest()
+    return value.hex()
+
+@bench()
+def bench_shared():
+    """
+    Prefork workers, each with its own LRU cache, or sharing one cache.
+    """
+    nworkers = 8
+    calls = 20000
+    context = multiprocessing.get_context("fork")
+    for name in ("per-process", "shared"):
+        if name == "shared":
+            cache = udon.cache.SharedMemoryCache(expensive, 256, slots = 16384)
+        results = context.Queue()
+        def worker(seed):
+            local = cache if name == "shared" else udon.cache.LRUCache(expensive, 16384)
+            rnd = random.Random(seed)
+            for _ in range(calls):
+                local(int(rnd.paretovariate(.5)) % 20000)
+            results.put(local.miss)
+        t0 = time.perf_counter()
+        workers = [ context.Process(target = worker, args = (i, )) for i in range(nworkers) ]
+        for process in workers:
+            process.start()
+        computed = sum(results.get() for _ in workers)
+        for process in workers:
+            process.join()
+        dt = time.perf_counter() - t0
+        print("%-12s workers=%d %.3fs computed=%d" % (name, nworkers, dt, computed))
+
+
+def main():
+    opts, names = getopt.getopt(sys.argv[1:], "t:")
+    for opt, arg in opts:
+        if opt == '-t':
+            TRACES.append((arg, load_trace(arg)))
+    for func in BENCHS:
+        if names and func.__name__ not in names:
+            continue
+        print("===> %s" % func.__name__)
+        func()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import getopt
+import random
+import sys
+import time
+
+import udon.datastructure
+
+BENCHS = []
+def bench():
+    def _(func):
+        BENCHS.append(func)
+    return _
+
+
+COUNTS = [ 10 ** 4, 10 ** 5, 10 ** 6 ]
+
+def run_timers(queue, deadlines, cancel):
+    t0 = time.perf_counter()
+    for item, deadline in enumerate(deadlines):
+        queue.insert(item, deadline)
+    t1 = time.perf_counter()
+    if cancel is not None:
+        for item in range(0, len(deadlines), 2):
+            cancel(item)
+    t2 = time.perf_counter()
+    popped = 0
+    now = 0
+    while queue:
+        now += .1
+        for _ in queue.pop_until(now):
+            popped += 1
+    t3 = time.perf_counter()
+    return t1 - t0, t2 - t1, t3 - t2, popped
+
+
+@bench()
+def bench_timers():
+    """
+    Schedule timers over 60 seconds, cancel half of them, and pop the
+    others every 100ms.  The plain heap has no cancellation.
+    """
+    for count in COUNTS:
+        deadlines = [ random.uniform(0, 60) for _ in range(count) ]
+        for name, factory in (("heap", udon.datastructure.PriorityQueue),
+                              ("indexed", udon.datastructure.IndexedPriorityQueue),
+                              ("wheel", udon.datastructure.TimerWheel)):
+            queue = factory()
+            cancel = getattr(queue, "remove", None) or getattr(queue, "cancel", None)
+            insert, remove, pop, popped = run_timers(queue, deadlines, cancel)
+            print("%-8s timers=%-8d insert %.3fs cancel %.3fs pop %.3fs (%d)" % (
+                name, count, insert, remove, pop, popped))
+
+
+def main():
+    opts, names = getopt.getopt(sys.argv[1:], "n:")
+    for opt, arg in opts:
+        if opt == '-n':
+            COUNTS[:] = [ int(arg) ]
+    for func in BENCHS:
+        if names and func.__name__ not in names:
+            continue
+        print("===> %s" % func.__name__)
+        func()
+
+if __name__ == "__main__":
+    main()
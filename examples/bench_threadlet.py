@@ -0,0 +1,61 @@
+import asyncio
+import getopt
+import random
+import sys
+import time
+
+import udon.asynchronous
+
+BENCHS = []
+def bench():
+    def _(func):
+        BENCHS.append(func)
+    return _
+
+
+COUNTS = [ 10000, 100000 ]
+DURATION = 5
+
+@bench()
+def bench_periodic():
+    """
+    Many periodic tasklets doing nothing, with periods between 1 and
+    10 seconds.  Measure the CPU time the threadlet spends per run.
+    """
+    for count in COUNTS:
+        runs = [ 0 ]
+        def handler(task):
+            runs[0] += 1
+        thread = udon.asynchronous.Threadlet()
+        for i in range(count):
+            thread.tasklet("task%d" % i,
+                           delay = random.uniform(0, 10),
+                           period = random.uniform(1, 10))(handler)
+        thread.schedule(thread.stop, delay = DURATION)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        t0 = time.process_time()
+        thread.start()
+        thread.join(loop)
+        dt = time.process_time() - t0
+        loop.close()
+        print("tasklets=%-7d runs=%-7d cpu %.3fs %.1fus/run" % (
+            count, runs[0], dt, dt / max(1, runs[0]) * 1e6))
+
+
+def main():
+    global DURATION
+    opts, names = getopt.getopt(sys.argv[1:], "d:n:")
+    for opt, arg in opts:
+        if opt == '-d':
+            DURATION = float(arg)
+        elif opt == '-n':
+            COUNTS[:] = [ int(arg) ]
+    for func in BENCHS:
+        if names and func.__name__ not in names:
+            continue
+        print("===> %s" % func.__name__)
+        func()
+
+if __name__ == "__main__":
+    main()
@@ -14,12 +14,18 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 #
 import asyncio
+import collections
+import concurrent.futures
+import functools
 import inspect
 import logging
 import signal
+import threading
 import time
 import types
 
+import udon.datastructure
+
 
 def _logger(logger):
     return logger if logger is not None else logging.getLogger(__name__)
@@ -77,6 +83,20 @@ def collect_future(future, logger = None):
             logger.warning("FUTURE RESULT: %r", result)
 
 
+def _on_loop(method):
+    # Handlers offloaded to a thread pool may reschedule, trigger or
+    # stop things: these calls are passed to the loop of the threadlet.
+    @functools.wraps(method)
+    def _(self, *args, **kwargs):
+        thread = self if isinstance(self, Threadlet) else getattr(self, "thread", None)
+        if (thread is not None and thread._loop is not None and
+            thread._loop_thread != threading.get_ident()):
+            thread._loop.call_soon_threadsafe(functools.partial(method, self, *args, **kwargs))
+            return
+        return method(self, *args, **kwargs)
+    return _
+
+
 class Schedulable:
 
     timestamp = None
@@ -90,18 +110,21 @@ class Schedulable:
     def set_period(self, period = None):
         self._period = period
 
+    @_on_loop
     def schedule(self, delay = 0, period = None):
         if period is not None:
             self._period = period
         self.schedule_at(time.time() + delay)
 
+    @_on_loop
     def schedule_at(self, timestamp):
         if timestamp is None:
             timestamp = time.time()
         self.timestamp = timestamp
-        self.thread._scheduled.add(self)
+        self.thread._scheduled.insert(self, timestamp)
         self.thread._wakeup()
 
+    @_on_loop
     def cancel(self):
         if self._cancelled:
             return
@@ -109,6 +132,7 @@ class Schedulable:
         self.unschedule()
         self.thread._uninstall(self)
 
+    @_on_loop
     def unschedule(self):
         self.thread._scheduled.discard(self)
         self.thread._wakeup()
@@ -119,12 +143,14 @@ class Schedulable:
     def is_pending(self):
         return self in self.thread._pending
 
+    @_on_loop
     def suspend(self):
         if self._suspended:
             return
         self._suspended = True
         self.unschedule()
 
+    @_on_loop
     def resume(self):
         if not self._suspended:
             return
@@ -177,6 +203,7 @@ class EventMixin:
     def is_signal(self):
         return False
 
+    @_on_loop
     def trigger(self):
         self.timestamp = time.time()
         self.thread._scheduled.discard(self)
@@ -202,10 +229,16 @@ class Signal(EventMixin, DataMixin):
         return True
 
 
+def _offloaded(handler, arg):
+    return time.time(), handler(arg)
+
+
 class Tasklet(Schedulable, DataMixin):
 
     _running = False
     _handler = None
+    _executor = None
+    _concurrent = None
 
     def __init__(self, thread, params = None):
         Schedulable.__init__(self, thread)
@@ -215,6 +248,33 @@ class Tasklet(Schedulable, DataMixin):
     def set_handler(self, handler):
         self._handler = handler
 
+    def set_executor(self, executor):
+        """
+        Run a synchronous handler on the given executor, or inline
+        if False.  By default, the executor of the threadlet is used.
+        On a thread pool, the handler may schedule, suspend, trigger
+        or cancel things, and stop the threadlet: these calls are run
+        on the event loop.  It must not use the threadlet otherwise.
+        """
+        self._executor = executor
+
+    def set_concurrent(self, concurrent):
+        """
+        Run as a separate asyncio task, or not.  By default, tasklets
+        run concurrently if the threadlet allows more than one at once.
+        """
+        self._concurrent = concurrent
+
+    def is_concurrent(self):
+        if self._concurrent is None:
+            return self.thread.concurrency > 1
+        return self._concurrent
+
+    def get_executor(self):
+        if self._executor is None:
+            return self.thread.executor
+        return self._executor or None
+
     def is_running(self):
         return self._running
 
@@ -224,7 +284,12 @@ class Tasklet(Schedulable, DataMixin):
 
         self._running = True
         try:
-            value = self._handler(self)
+            executor = self.get_executor()
+            if executor is not None and not (inspect.iscoroutinefunction(self._handler) or
+                                             inspect.isgeneratorfunction(self._handler)):
+                value = await self.thread._offload(executor, self._handler, self)
+            else:
+                value = self._handler(self)
             if isinstance(value, types.CoroutineType):
                 value = await value
             elif isinstance(value, types.GeneratorType):
@@ -248,13 +313,21 @@ class Threadlet:
     _coro = None
     _stopping = False
     _ready = None
+    _semaphore = None
+    _loop = None
+    _loop_thread = None
 
-    def __init__(self, logger = None):
+    def __init__(self, logger = None, executor = None, concurrency = 1):
         self.logger = _logger(logger)
+        self.executor = executor
+        self.concurrency = concurrency
+        self._tasks = {}
+        self._rerun = set()
+        self._offload_stats = collections.Counter()
         self._schedulables = {}
         self._schedulables_rev = {}
         self._pending = set()
-        self._scheduled = set()
+        self._scheduled = udon.datastructure.IndexedPriorityQueue()
 
     def __contains__(self, key):
         return key in self._schedulables
@@ -278,6 +351,8 @@ class Threadlet:
             collect_future(future, self.logger)
 
         async def run():
+            self._loop = asyncio.get_event_loop()
+            self._loop_thread = threading.get_ident()
             if delay:
                 await asyncio.sleep(delay)
             await (func or default_func)(self)
@@ -285,11 +360,14 @@ class Threadlet:
         def done(future):
             self._pending.clear()
             self._scheduled.clear()
+            for task in self._tasks.values():
+                task.cancel()
             try:
                 (when_done or default_done)(future)
             except:
                 self.logger.exception("done: %r", self)
             del self._coro
+            self._loop = None
 
         if func is not None and not inspect.iscoroutinefunction(func):
             raise TypeError("not a coroutine function")
@@ -297,6 +375,7 @@ class Threadlet:
         self._coro = asyncio.ensure_future(run())
         self._coro.add_done_callback(done)
 
+    @_on_loop
     def stop(self):
         if not self._stopping:
             self._stopping = True
@@ -315,32 +394,63 @@ class Threadlet:
             pass
 
     async def __aiter__(self):
-        while not self._stopping:
-            if not self._ready:
-                # wait for the next batch of events
-                self._ready = await self._wait_for_events()
-                continue
-            item = self._ready.pop(0)
-            if isinstance(item, Tasklet):
-                await item.run()
-            elif isinstance(item, Signal):
-                yield item
-            elif isinstance(item, Event):
-                yield item
-                item._reschedule()
+        try:
+            while not self._stopping:
+                if not self._ready:
+                    # wait for the next batch of events
+                    self._ready = await self._wait_for_events()
+                    continue
+                item = self._ready.popleft()
+                if isinstance(item, Tasklet):
+                    if item.is_concurrent():
+                        self._spawn(item)
+                    else:
+                        await item.run()
+                elif isinstance(item, Signal):
+                    yield item
+                elif isinstance(item, Event):
+                    yield item
+                    item._reschedule()
+            # let the running tasklets complete
+            while self._tasks:
+                await asyncio.wait(list(self._tasks.values()))
+        except asyncio.CancelledError:
+            for task in self._tasks.values():
+                task.cancel()
+            raise
+
+    def _spawn(self, tasklet):
+        # a tasklet never overlaps itself: if it is already running,
+        # run it again once done.
+        if tasklet in self._tasks:
+            self._rerun.add(tasklet)
+            return
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._tasks[tasklet] = asyncio.ensure_future(self._run_tasklet(tasklet))
+
+    async def _run_tasklet(self, tasklet):
+        try:
+            while True:
+                async with self._semaphore:
+                    await tasklet.run()
+                if tasklet not in self._rerun or self._stopping:
+                    break
+                self._rerun.discard(tasklet)
+        finally:
+            self._rerun.discard(tasklet)
+            del self._tasks[tasklet]
 
     async def _wait_for_events(self):
         while not self._stopping:
-            # get the set of scheduled events that are ready
-            now = time.time()
-            events = { evt for evt in self._scheduled if evt.timestamp <= now }
-            self._scheduled.difference_update(events)
-            # if there are pending events or signals, add them to the set
+            # get the scheduled events that are ready, in order
+            events = [ evt for evt, _ in self._scheduled.pop_until(time.time()) ]
+            # if there are pending events or signals, merge them in
             if self._pending:
-                events.update(self._pending)
+                events = sorted(self._pending.union(events), key = lambda x: x.timestamp)
                 self._pending.clear()
             if events:
-                return sorted(events, key = lambda x: x.timestamp)
+                return collections.deque(events)
             await self._sleep()
 
     def _task(self, func, name, params = None):
@@ -378,13 +488,16 @@ class Threadlet:
         sig = Signal(self, params = kwargs)
         sig.trigger()
 
-    def tasklet(self, name = None, suspend = False, delay = 0, period = None, **kwargs):
+    def tasklet(self, name = None, suspend = False, delay = 0, period = None, executor = None,
+                concurrent = None, **kwargs):
         def _(func):
             sname = name
             if sname is None:
                 sname = func.__name__
             task = self._task(func, sname, params = kwargs)
             task.set_period(period)
+            task.set_executor(executor)
+            task.set_concurrent(concurrent)
             task.schedule(delay)
             if suspend:
                 task.suspend()
@@ -401,14 +514,53 @@ class Threadlet:
         def _(task):
             return func()
         task = self._task(_, name)
+        task.set_executor(False)
         task.schedule(delay)
         return task
 
+    async def _offload(self, executor, handler, task):
+        # A process pool gets a copy of the parameters, as the
+        # tasklet itself does not cross process boundaries.
+        if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+            arg = dict(task._data or {})
+        else:
+            arg = task
+        stats = self._offload_stats
+        stats['submitted'] += 1
+        stats['pending'] += 1
+        stats['max_pending'] = max(stats['max_pending'], stats['pending'])
+        submitted = time.time()
+        try:
+            started, value = await asyncio.get_event_loop().run_in_executor(
+                executor, _offloaded, handler, arg)
+        except:
+            stats['failed'] += 1
+            raise
+        else:
+            stats['completed'] += 1
+            wait = max(0, started - submitted)
+            stats['wait'] += wait
+            stats['max_wait'] = max(stats['max_wait'], wait)
+        finally:
+            stats['pending'] -= 1
+        return value
+
+    def offload_stats(self):
+        """
+        Return the counters of the handlers run on executors: submitted,
+        pending, completed and failed calls, and the time spent waiting
+        for a worker, a sign of pool saturation.
+        """
+        stats = dict.fromkeys(('submitted', 'pending', 'max_pending', 'completed',
+                               'failed', 'wait', 'max_wait'), 0)
+        stats.update(self._offload_stats)
+        return stats
+
     async def _sleep(self):
         self._future = asyncio.Future()
         try:
             if self._scheduled:
-                timestamp = min(entry.timestamp for entry in self._scheduled)
+                _, timestamp = self._scheduled.peek()
                 delay = max(0.0001, timestamp - time.time())
                 await asyncio.wait_for(self._future, delay)
             else:
@@ -421,6 +573,7 @@ class Threadlet:
             if self._future:
                 del self._future
 
+    @_on_loop
     def _wakeup(self):
         if not self._future:
             return
@@ -13,8 +13,25 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 #
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import hashlib
+import heapq
+import inspect
+import itertools
+import logging
+import mmap
+import multiprocessing
+import pickle
+import struct
+import threading
 import time
+import weakref
 
+import udon.content
+import udon.path
 import udon.util
 
 
@@ -23,25 +40,229 @@ class NoCache(Exception):
         self.value = value
 
 
+class _Flight:
+    """
+    A computation in progress for a key.  The lock is held by the
+    computing thread until the result is available.
+    """
+
+    __slots__ = "lock", "owner", "value", "error"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lock.acquire()
+        self.owner = threading.get_ident()
+        self.error = None
+
+    def set_result(self, value):
+        self.value = value
+        self.lock.release()
+
+    def set_error(self, error):
+        self.error = error
+        self.lock.release()
+
+    def wait(self):
+        if self.owner == threading.get_ident() and self.lock.locked():
+            raise RuntimeError("recursive computation of a cached value")
+        with self.lock:
+            pass
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class Histogram:
+    """
+    Count values in buckets bounded by the given upper limits.
+    """
+
+    BOUNDS = (.00001, .0001, .001, .01, .1, 1, 10)
+
+    def __init__(self, bounds = None):
+        self.bounds = self.BOUNDS if bounds is None else tuple(bounds)
+        self.counts = [ 0 ] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def stats(self):
+        return { 'count': self.count,
+                 'sum': self.total,
+                 'max': self.max,
+                 'buckets': list(zip(self.bounds + (float('inf'), ), self.counts)) }
+
+
+class CacheMetrics:
+    """
+    Default metrics hook for caches.  Subclass it, or provide an object
+    with the same on_*() methods, to forward the measurements elsewhere.
+    """
+
+    def __init__(self):
+        self.compute = Histogram()
+        self.lock_wait = Histogram()
+        self.evictions = 0
+        self.expirations = 0
+
+    def on_compute(self, duration):
+        self.compute.add(duration)
+
+    def on_lock_wait(self, duration):
+        self.lock_wait.add(duration)
+
+    def on_evict(self, count):
+        self.evictions += count
+
+    def on_expire(self, count):
+        self.expirations += count
+
+    def stats(self):
+        return { 'compute': self.compute.stats(),
+                 'lock_wait': self.lock_wait.stats(),
+                 'evictions': self.evictions,
+                 'expirations': self.expirations }
+
+
+class _TimedLock:
+
+    def __init__(self, lock, metrics):
+        self.lock = lock
+        self.metrics = metrics
+
+    def __enter__(self):
+        t0 = time.perf_counter()
+        self.lock.__enter__()
+        self.metrics.on_lock_wait(time.perf_counter() - t0)
+
+    def __exit__(self, _type, _value, _traceback):
+        return self.lock.__exit__(_type, _value, _traceback)
+
+
+_caches = weakref.WeakSet()
+
+def caches():
+    """
+    Return all the live caches.
+    """
+    return list(_caches)
+
+def stats():
+    """
+    Return the statistics of all the live caches.
+    """
+    return [ cache.stats() for cache in caches() ]
+
+
 class AbstractCache:
 
     hit = 0
     miss = 0
     skip = 0
     lock = udon.util.nullcontext()
+    metrics = None
 
     def __init__(self, func, lock = None):
         self.func = func
         if lock is not None:
             self.lock = lock
+        self.flights = {}
+        _caches.add(self)
+
+    @property
+    def name(self):
+        return getattr(self.func, '__qualname__', repr(self.func))
+
+    def set_metrics(self, metrics):
+        if isinstance(self.lock, _TimedLock):
+            self.lock = self.lock.lock
+        self.metrics = metrics
+        if metrics is not None and not isinstance(self.lock, udon.util.nullcontext):
+            self.lock = _TimedLock(self.lock, metrics)
+
+    def stats(self):
+        result = { 'name': self.name,
+                   'type': type(self).__name__,
+                   'size': len(self),
+                   'hit': self.hit,
+                   'miss': self.miss,
+                   'skip': self.skip }
+        if self.metrics is not None and hasattr(self.metrics, 'stats'):
+            result.update(self.metrics.stats())
+        return result
+
+    def _computed(self, t0):
+        if self.metrics is not None:
+            self.metrics.on_compute(time.perf_counter() - t0)
+
+    def _evicted(self, count = 1):
+        if self.metrics is not None:
+            self.metrics.on_evict(count)
+
+    def _expired(self, count = 1):
+        if self.metrics is not None:
+            self.metrics.on_expire(count)
 
     def __call__(self, *key):
+        # The lock only guards the lookup and the bookkeeping. The
+        # value is computed outside of it by the first caller, and
+        # concurrent callers for the same key wait for the result.
         with self.lock:
             try:
-                return self.do_get(*key)
-            except NoCache as res:
+                value = self.do_lookup(key)
+            except KeyError:
+                pass
+            else:
+                self.hit += 1
+                return value
+            # setdefault() is atomic, so that concurrent misses agree
+            # on a single flight even without a lock.
+            flight = _Flight()
+            pending = self.flights.setdefault(key, flight)
+            if pending is flight:
+                pending = None
+                self.miss += 1
+            else:
+                self.hit += 1
+
+        if pending is not None:
+            return pending.wait()
+
+        t0 = time.perf_counter()
+        try:
+            value = self.do_compute(*key)
+        except NoCache as res:
+            self._computed(t0)
+            with self.lock:
                 self.skip += 1
-                return res.value
+                del self.flights[key]
+            flight.set_result(res.value)
+            return res.value
+        except BaseException as exc:
+            with self.lock:
+                del self.flights[key]
+            flight.set_error(exc)
+            raise
+        self._computed(t0)
+
+        try:
+            with self.lock:
+                try:
+                    self.do_insert(key, value)
+                finally:
+                    del self.flights[key]
+        except BaseException as exc:
+            flight.set_error(exc)
+            raise
+        flight.set_result(value)
+        return value
 
     def __len__(self):
         with self.lock:
@@ -51,10 +272,83 @@ class AbstractCache:
         with self.lock:
             return self.do_clear()
 
+    def snapshot(self, path, values = False, tmpdir = None):
+        """
+        Save the cached keys, and the values if requested, to a file,
+        hottest first.  Return the number of entries.
+        """
+        with self.lock:
+            records = list(self.do_save(values))
+        with udon.path.overwriting(path, tmpdir = tmpdir) as fp:
+            pickler = pickle.Pickler(fp, pickle.HIGHEST_PROTOCOL)
+            for record in records:
+                pickler.dump(record)
+        return len(records)
+
+    def preload(self, path, workers = 4):
+        """
+        Load a snapshot.  Saved values are inserted directly. Keys
+        saved alone are recomputed in the background, hottest first,
+        by a pool of threads, or by tasks of the running loop for the
+        async caches.  Return the futures of the computations.
+        """
+        records = []
+        with open(path, "rb") as fp:
+            unpickler = pickle.Unpickler(fp)
+            while True:
+                try:
+                    records.append(unpickler.load())
+                except EOFError:
+                    break
+
+        # insert the coldest values first.
+        for record in reversed(records):
+            if len(record) > 1:
+                with self.lock:
+                    self.do_restore(*record)
+
+        keys = [ record[0] for record in records if len(record) == 1 ]
+        if not keys:
+            return []
+        return self.do_recompute(keys, workers)
+
+    def do_save(self, values):
+        """
+        Iterate over the snapshot records, hottest first.
+        """
+        for key, value in self.do_items():
+            yield (key, value) if values else (key, )
+
+    def do_restore(self, key, value):
+        """
+        Insert a saved value, unless the key is already cached.
+        """
+        try:
+            self.do_lookup(key)
+        except KeyError:
+            self.do_insert(key, value)
+
+    def do_recompute(self, keys, workers):
+        """
+        Start the computation of the saved keys in the background,
+        hottest first, with at most 'workers' at once.  Return the
+        futures.
+        """
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+        futures = [ executor.submit(self, *key) for key in keys ]
+        executor.shutdown(wait = False)
+        return futures
+
     def do_compute(self, *key):
         return self.func(*key)
 
-    def do_get(self, *key):
+    def do_lookup(self, key):
+        """
+        Return the cached value for the key, or raise KeyError.
+        """
+        raise NotImplementedError
+
+    def do_insert(self, key, value):
         raise NotImplementedError
 
     def do_size(self):
@@ -63,6 +357,12 @@ class AbstractCache:
     def do_clear(self):
         raise NotImplementedError
 
+    def do_items(self):
+        """
+        Iterate over the cached (key, value) pairs, hottest first.
+        """
+        raise NotImplementedError
+
 
 
 _UNDEFINED = object()
@@ -100,72 +400,1130 @@ class LRUCache(AbstractCache):
     def do_size(self):
         return len(self.mapping)
 
-    def do_get(self, *key):
-        node = self.mapping.get(key)
-        if node is None:
-            self.miss += 1
-            value = self.do_compute(*key)
-            if len(self.mapping) >= self.size:
-                old = self.head.next
-                old.remove()
-                del self.mapping[old.key]
-            self.mapping[key] = node = LRUNode(key, value)
-            node.insert_before(self.tail)
-        else:
-            self.hit += 1
-            node.remove()
-            node.insert_before(self.tail)
+    def do_lookup(self, key):
+        node = self.mapping[key]
+        node.remove()
+        node.insert_before(self.tail)
         return node.value
 
+    def do_insert(self, key, value):
+        node = self.mapping.pop(key, None)
+        if node is not None:
+            node.remove()
+        elif len(self.mapping) >= self.size:
+            self.do_evict()
+        self.mapping[key] = node = LRUNode(key, value)
+        node.insert_before(self.tail)
+
+    def do_evict(self):
+        node = self.head.next
+        node.remove()
+        del self.mapping[node.key]
+        self._evicted()
+
     def do_clear(self):
         self.mapping.clear()
         self.head.next = self.tail
         self.tail.prev = self.head
 
+    def do_items(self):
+        node = self.tail.prev
+        while node is not self.head:
+            yield node.key, node.value
+            node = node.prev
 
-def lru_cache(size, lock = None):
+
+def lru_cache(size, lock = None, shards = None):
     def _(func):
+        if shards:
+            return ShardedLRUCache(func, size, shards = shards, lock = lock)
         return LRUCache(func, size, lock = lock)
     return _
 
 
+class WeightedLRUNode(LRUNode):
+
+    __slots__ = "weight",
+
+
+class WeightedLRUCache(LRUCache):
+    """
+    LRU cache bounded by the total weight of its values, as given by
+    weigher(key, value).  Values heavier than the maximum weight are
+    not cached.
+    """
+
+    weight = 0
+
+    def __init__(self, func, weigher, max_weight, lock = None):
+        super().__init__(func, None, lock = lock)
+        self.weigher = weigher
+        self.max_weight = max_weight
+
+    def do_insert(self, key, value):
+        weight = self.weigher(key, value)
+        if weight > self.max_weight:
+            self.skip += 1
+            return
+        node = self.mapping.pop(key, None)
+        if node is not None:
+            node.remove()
+            self.weight -= node.weight
+        while self.weight + weight > self.max_weight:
+            self.do_evict()
+        self.mapping[key] = node = WeightedLRUNode(key, value)
+        node.weight = weight
+        node.insert_before(self.tail)
+        self.weight += weight
+
+    def do_evict(self):
+        self.weight -= self.head.next.weight
+        super().do_evict()
+
+    def do_clear(self):
+        super().do_clear()
+        self.weight = 0
+
+
+def weighted_lru_cache(max_weight, weigher, lock = None):
+    def _(func):
+        return WeightedLRUCache(func, weigher, max_weight, lock = lock)
+    return _
+
+
+_LOCK_TYPE = type(threading.Lock())
+class ShardedLRUCache(AbstractCache):
+    """
+    Spread the keys over independent LRU caches, each with its own
+    lock, to reduce contention.  The lock argument is a lock, whose
+    type is used for the per-shard locks, a factory for them, or True
+    for threading.Lock.
+    """
+
+    def __init__(self, func, size, shards = 16, lock = None):
+        super().__init__(func)
+        if lock is True or isinstance(lock, _LOCK_TYPE):
+            lock = threading.Lock
+        elif hasattr(lock, "acquire"):
+            lock = type(lock)
+        shard_size = -(-size // shards)
+        self.shards = [ LRUCache(func, shard_size, lock = lock() if lock else None)
+                        for _ in range(shards) ]
+        for shard in self.shards:
+            _caches.discard(shard)
+
+    def __call__(self, *key):
+        return self.shards[hash(key) % len(self.shards)](*key)
+
+    def set_metrics(self, metrics):
+        super().set_metrics(metrics)
+        for shard in self.shards:
+            shard.set_metrics(metrics)
+
+    @property
+    def hit(self):
+        return sum(shard.hit for shard in self.shards)
+
+    @property
+    def miss(self):
+        return sum(shard.miss for shard in self.shards)
+
+    @property
+    def skip(self):
+        return sum(shard.skip for shard in self.shards)
+
+    def do_size(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def do_clear(self):
+        for shard in self.shards:
+            shard.clear()
+
+    def do_lookup(self, key):
+        shard = self.shards[hash(key) % len(self.shards)]
+        with shard.lock:
+            return shard.do_lookup(key)
+
+    def do_insert(self, key, value):
+        shard = self.shards[hash(key) % len(self.shards)]
+        with shard.lock:
+            shard.do_insert(key, value)
+
+    def do_items(self):
+        items = []
+        for shard in self.shards:
+            with shard.lock:
+                items.append(list(shard.do_items()))
+        for entries in itertools.zip_longest(*items):
+            for entry in entries:
+                if entry is not None:
+                    yield entry
+
+
+class ARCCache(AbstractCache):
+    """
+    Adaptive Replacement Cache. Entries seen once and entries seen
+    several times are kept in separate LRU lists, and the ghost lists
+    of recently evicted keys adapt the balance between the two. A scan
+    only goes through the first list.
+    """
+
+    def __init__(self, func, size, lock = None):
+        super().__init__(func, lock = lock)
+        self.size = size
+        self.p = 0
+        self.t1 = collections.OrderedDict()
+        self.t2 = collections.OrderedDict()
+        self.b1 = collections.OrderedDict()
+        self.b2 = collections.OrderedDict()
+
+    def do_size(self):
+        return len(self.t1) + len(self.t2)
+
+    def do_lookup(self, key):
+        if key in self.t1:
+            value = self.t2[key] = self.t1.pop(key)
+            return value
+        value = self.t2[key]
+        self.t2.move_to_end(key)
+        return value
+
+    def do_insert(self, key, value):
+        size = self.size
+        if key in self.t1 or key in self.t2:
+            self.t1.pop(key, None)
+            self.t2[key] = value
+            return
+        if key in self.b1:
+            self.p = min(size, self.p + max(len(self.b2) // len(self.b1), 1))
+            del self.b1[key]
+            self.do_evict()
+            self.t2[key] = value
+            return
+        if key in self.b2:
+            self.p = max(0, self.p - max(len(self.b1) // len(self.b2), 1))
+            del self.b2[key]
+            self.do_evict(ghost = True)
+            self.t2[key] = value
+            return
+        if len(self.t1) + len(self.b1) >= size:
+            if len(self.t1) < size:
+                self.b1.popitem(last = False)
+                self.do_evict()
+            else:
+                self.t1.popitem(last = False)
+                self._evicted()
+        else:
+            total = len(self.t1) + len(self.t2) + len(self.b1) + len(self.b2)
+            if total >= size:
+                if total >= 2 * size:
+                    self.b2.popitem(last = False)
+                self.do_evict()
+        self.t1[key] = value
+
+    def do_evict(self, ghost = False):
+        # ghost is set when the key being inserted was found in b2.
+        if len(self.t1) + len(self.t2) < self.size:
+            return
+        if self.t1 and (len(self.t1) > self.p or (ghost and len(self.t1) == self.p)):
+            old, _ = self.t1.popitem(last = False)
+            self.b1[old] = None
+        else:
+            old, _ = self.t2.popitem(last = False)
+            self.b2[old] = None
+        self._evicted()
+
+    def do_clear(self):
+        self.p = 0
+        for mapping in (self.t1, self.t2, self.b1, self.b2):
+            mapping.clear()
+
+    def do_items(self):
+        yield from reversed(self.t2.items())
+        yield from reversed(self.t1.items())
+
+
+def arc_cache(size, lock = None):
+    def _(func):
+        return ARCCache(func, size, lock = lock)
+    return _
+
+
+class ClockCache(AbstractCache):
+    """
+    CLOCK (second chance) approximation of LRU. Entries live in fixed
+    slot tables, and a hit only sets the reference bit of the slot,
+    without taking the lock. On eviction, the clock hand sweeps the
+    slots, clearing the bits, until it finds one that is not set.
+
+    The hit counter is not updated under the lock, so it may lose a
+    few increments when used from several threads.
+    """
+
+    def __init__(self, func, size, lock = None):
+        super().__init__(func, lock = lock)
+        self.size = size
+        self.index = {}
+        self.keys = [ _UNDEFINED ] * size
+        self.values = [ None ] * size
+        self.refs = bytearray(size)
+        self.hand = 0
+        self.used = 0
+
+    def __call__(self, *key):
+        slot = self.index.get(key)
+        if slot is not None:
+            # The slot may be reused concurrently: read the value
+            # first, and check that it still belongs to the key.
+            value = self.values[slot]
+            if self.keys[slot] == key:
+                self.refs[slot] = 1
+                self.hit += 1
+                return value
+        return super().__call__(*key)
+
+    def do_size(self):
+        return len(self.index)
+
+    def do_lookup(self, key):
+        slot = self.index[key]
+        self.refs[slot] = 1
+        return self.values[slot]
+
+    def do_insert(self, key, value):
+        slot = self.index.get(key)
+        if slot is None:
+            if self.used < self.size:
+                slot = self.used
+                self.used += 1
+            else:
+                slot = self.do_evict()
+        self.keys[slot] = _UNDEFINED
+        self.values[slot] = value
+        self.keys[slot] = key
+        self.index[key] = slot
+
+    def do_evict(self):
+        refs = self.refs
+        hand = self.hand
+        while refs[hand]:
+            refs[hand] = 0
+            hand = (hand + 1) % self.size
+        self.hand = (hand + 1) % self.size
+        del self.index[self.keys[hand]]
+        self.keys[hand] = _UNDEFINED
+        self.values[hand] = None
+        self._evicted()
+        return hand
+
+    def do_clear(self):
+        self.index = {}
+        self.keys = [ _UNDEFINED ] * self.size
+        self.values = [ None ] * self.size
+        self.refs = bytearray(self.size)
+        self.hand = 0
+        self.used = 0
+
+    def do_items(self):
+        # referenced entries first
+        for ref in (1, 0):
+            for key, slot in list(self.index.items()):
+                if self.refs[slot] == ref:
+                    yield key, self.values[slot]
+
+
+def clock_cache(size, lock = None):
+    def _(func):
+        return ClockCache(func, size, lock = lock)
+    return _
+
+
+class FrequencySketch:
+    """
+    Count-min sketch of 4-bit counters, used to estimate the access
+    frequency of keys.  All counters are halved periodically so that
+    old accesses fade out.
+    """
+
+    SEEDS = (0x9e3779b97f4a7c15, 0xc2b2ae3d27d4eb4f, 0x165667b19e3779f9, 0x27d4eb2f165667c5)
+
+    def __init__(self, size):
+        self.width = 1 << max(4, size.bit_length())
+        self.mask = self.width - 1
+        self.table = bytearray(self.width * len(self.SEEDS))
+        self.limit = 10 * max(size, 1)
+        self.samples = 0
+
+    def _indexes(self, key):
+        value = hash(key) & 0xffffffffffffffff
+        value ^= value >> 31
+        width, mask = self.width, self.mask
+        return [ row * width + ((((value * seed) & 0xffffffffffffffff) >> 32) & mask)
+                 for row, seed in enumerate(self.SEEDS) ]
+
+    def increment(self, key):
+        table = self.table
+        for index in self._indexes(key):
+            if table[index] < 15:
+                table[index] += 1
+        self.samples += 1
+        if self.samples >= self.limit:
+            self.table = bytearray(count >> 1 for count in table)
+            self.samples //= 2
+
+    def frequency(self, key):
+        table = self.table
+        return min([ table[index] for index in self._indexes(key) ])
+
+
+class TinyLFUCache(AbstractCache):
+    """
+    W-TinyLFU cache. New entries go through a small LRU window. On
+    eviction from the window, they are only admitted in the main
+    segmented LRU if they are used more often than the entry they
+    would replace, as estimated by a frequency sketch.
+    """
+
+    def __init__(self, func, size, lock = None):
+        super().__init__(func, lock = lock)
+        self.size = size
+        self.window_size = max(1, size // 100)
+        self.main_size = max(0, size - self.window_size)
+        self.protected_size = self.main_size * 8 // 10
+        self.sketch = FrequencySketch(size)
+        self.window = collections.OrderedDict()
+        self.probation = collections.OrderedDict()
+        self.protected = collections.OrderedDict()
+
+    def do_size(self):
+        return len(self.window) + len(self.probation) + len(self.protected)
+
+    def do_lookup(self, key):
+        self.sketch.increment(key)
+        if key in self.window:
+            self.window.move_to_end(key)
+            return self.window[key]
+        if key in self.protected:
+            self.protected.move_to_end(key)
+            return self.protected[key]
+        value = self.protected[key] = self.probation.pop(key)
+        if len(self.protected) > self.protected_size:
+            old, old_value = self.protected.popitem(last = False)
+            self.probation[old] = old_value
+        return value
+
+    def do_insert(self, key, value):
+        for mapping in (self.window, self.probation, self.protected):
+            if key in mapping:
+                mapping[key] = value
+                return
+        self.window[key] = value
+        if len(self.window) <= self.window_size:
+            return
+        candidate, candidate_value = self.window.popitem(last = False)
+        if len(self.probation) + len(self.protected) < self.main_size:
+            self.probation[candidate] = candidate_value
+            return
+        victims = self.probation or self.protected
+        if not victims:
+            self._evicted()
+            return
+        victim = next(iter(victims))
+        if self.sketch.frequency(candidate) > self.sketch.frequency(victim):
+            self.do_evict(victims)
+            self.probation[candidate] = candidate_value
+        else:
+            self._evicted()
+
+    def do_evict(self, mapping):
+        mapping.popitem(last = False)
+        self._evicted()
+
+    def do_clear(self):
+        for mapping in (self.window, self.probation, self.protected):
+            mapping.clear()
+
+    def do_items(self):
+        for mapping in (self.protected, self.window, self.probation):
+            yield from reversed(mapping.items())
+
+
+def tinylfu_cache(size, lock = None):
+    def _(func):
+        return TinyLFUCache(func, size, lock = lock)
+    return _
+
+
+class SharedMemoryCache(AbstractCache):
+    """
+    Cache shared by the processes forked after its creation.
+
+    Entries are pickled into a fixed number of slots of a shared
+    memory map.  A key hashes to a bucket of 'ways' slots, and the
+    least recently used slot of the bucket is replaced when it is
+    full.  Buckets are protected by a set of process-shared locks.
+
+    Keys and values are stored inline: an entry whose pickled key and
+    value exceed 'slot_size' bytes is never cached, and only counted
+    in 'skip'.  The slot size must be chosen for the expected values,
+    the map taking 'slots' times that much memory.
+    """
+
+    _SLOT = struct.Struct("<QQII") # hash, stamp, key length, value length
+
+    def __init__(self, func, slot_size, slots = 4096, ways = 8, locks = 64, lock = None):
+        super().__init__(func, lock = lock)
+        self.ways = ways
+        self.buckets = max(1, slots // ways)
+        self.slot_size = slot_size
+        self.stride = self._SLOT.size + slot_size
+        self.buf = mmap.mmap(-1, self.buckets * ways * self.stride)
+        self.locks = [ multiprocessing.Lock() for _ in range(min(locks, self.buckets)) ]
+
+    def _slots(self, key):
+        data = pickle.dumps(key, pickle.HIGHEST_PROTOCOL)
+        value = int.from_bytes(hashlib.blake2b(data, digest_size = 8).digest(), 'little') | 1
+        bucket = value % self.buckets
+        start = bucket * self.ways * self.stride
+        slots = range(start, start + self.ways * self.stride, self.stride)
+        return data, value, self.locks[bucket % len(self.locks)], slots
+
+    def _find(self, slots, value, data):
+        buf, hdr = self.buf, self._SLOT.size
+        for offset in slots:
+            hashed, _, klen, vlen = self._SLOT.unpack_from(buf, offset)
+            if hashed == value and buf[offset + hdr:offset + hdr + klen] == data:
+                return offset, klen, vlen
+        return None, 0, 0
+
+    def do_lookup(self, key):
+        data, value, lock, slots = self._slots(key)
+        with lock:
+            offset, klen, vlen = self._find(slots, value, data)
+            if offset is None:
+                raise KeyError(key)
+            self._SLOT.pack_into(self.buf, offset, value, time.monotonic_ns(), klen, vlen)
+            start = offset + self._SLOT.size + klen
+            result = self.buf[start:start + vlen]
+        return pickle.loads(result)
+
+    def do_insert(self, key, value):
+        vdata = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        data, hashed, lock, slots = self._slots(key)
+        if len(data) + len(vdata) > self.slot_size:
+            self.skip += 1
+            return
+        with lock:
+            offset, _, _ = self._find(slots, hashed, data)
+            if offset is None:
+                # use the least recently used slot, empty ones first
+                offset = min(slots, key = lambda x: self._SLOT.unpack_from(self.buf, x)[1])
+                if self._SLOT.unpack_from(self.buf, offset)[0]:
+                    self._evicted()
+            start = offset + self._SLOT.size
+            self.buf[start:start + len(data)] = data
+            self.buf[start + len(data):start + len(data) + len(vdata)] = vdata
+            self._SLOT.pack_into(self.buf, offset, hashed, time.monotonic_ns(), len(data), len(vdata))
+
+    def _each_bucket(self):
+        stride = self.ways * self.stride
+        for bucket in range(self.buckets):
+            with self.locks[bucket % len(self.locks)]:
+                yield range(bucket * stride, (bucket + 1) * stride, self.stride)
+
+    def do_size(self):
+        count = 0
+        for slots in self._each_bucket():
+            count += sum(1 for offset in slots if self._SLOT.unpack_from(self.buf, offset)[0])
+        return count
+
+    def do_clear(self):
+        for slots in self._each_bucket():
+            for offset in slots:
+                self._SLOT.pack_into(self.buf, offset, 0, 0, 0, 0)
+
+    def do_items(self):
+        # the slots are ordered by their last use, across processes.
+        entries = []
+        hdr = self._SLOT.size
+        for slots in self._each_bucket():
+            for offset in slots:
+                hashed, stamp, klen, vlen = self._SLOT.unpack_from(self.buf, offset)
+                if hashed:
+                    start = offset + hdr
+                    entries.append((stamp, self.buf[start:start + klen],
+                                    self.buf[start + klen:start + klen + vlen]))
+        entries.sort(key = lambda entry: entry[0], reverse = True)
+        for _, key, value in entries:
+            yield pickle.loads(key), pickle.loads(value)
+
+
+def shared_memory_cache(slot_size, slots = 4096, **kwargs):
+    def _(func):
+        return SharedMemoryCache(func, slot_size, slots = slots, **kwargs)
+    return _
+
+
+class TieredNode(LRUNode):
+
+    __slots__ = "expires",
+
+
+class TieredCache(LRUCache):
+    """
+    In-memory LRU cache in front of a second tier of content files in
+    a store, which survives restarts.  Values are pickled on disk, and
+    expire after 'delay' seconds if set, in both tiers.  Values found
+    on disk are promoted to memory.  At most 'store_size' entries are
+    kept on disk, the least recently used ones being removed first.
+    Files are read and written outside of the lock.
+    """
+
+    store_hit = 0
+
+    def __init__(self, func, size, store, store_size, delay = None, lock = None):
+        super().__init__(func, size, lock = lock)
+        self.store = store
+        self.store_size = store_size
+        self.delay = delay
+        self.promoted = {}
+        self.index = collections.OrderedDict()
+        entries = [ (store.stat(skey).st_mtime, skey)
+                    for skey in store.walk() if len(skey) == 64 ]
+        for _, skey in sorted(entries):
+            self.index[skey] = None
+        for skey in self.do_store_trim():
+            self._store_delete(skey)
+
+    def _store_key(self, key):
+        return hashlib.sha256(pickle.dumps(key, pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+    def do_lookup(self, key):
+        node = self.mapping[key]
+        if node.expires is not None and node.expires <= time.time():
+            node.remove()
+            del self.mapping[key]
+            self._expired()
+            raise KeyError(key)
+        return super().do_lookup(key)
+
+    def do_insert(self, key, value):
+        # values promoted from disk keep their expiration time.
+        expires = self.promoted.pop(key, None)
+        if expires is None and self.delay is not None:
+            expires = time.time() + self.delay
+        node = self.mapping.pop(key, None)
+        if node is not None:
+            node.remove()
+        elif len(self.mapping) >= self.size:
+            self.do_evict()
+        self.mapping[key] = node = TieredNode(key, value)
+        node.expires = expires
+        node.insert_before(self.tail)
+
+    def do_compute(self, *key):
+        # called outside of the lock on a memory miss.
+        try:
+            value, expires = self.store_lookup(key)
+        except KeyError:
+            pass
+        else:
+            with self.lock:
+                self.store_hit += 1
+                self.promoted[key] = expires
+            return value
+        value = super().do_compute(*key)
+        self.store_insert(key, value)
+        return value
+
+    def store_lookup(self, key):
+        """
+        Return the value and expiration time of a key from the disk
+        tier, or raise KeyError.
+        """
+        skey = self._store_key(key)
+        with self.lock:
+            if skey not in self.index:
+                raise KeyError(key)
+        try:
+            with udon.content.reader(self.store.path(skey)) as fp:
+                expires = dict(fp.info.headers).get("Expires")
+                if expires is not None:
+                    expires = float(expires)
+                    if expires <= time.time():
+                        raise KeyError(key)
+                stored_key, value = pickle.loads(fp.read())
+        except Exception:
+            self.store_remove(skey)
+            raise KeyError(key)
+        if stored_key != key:
+            raise KeyError(key)
+        with self.lock:
+            if skey in self.index:
+                self.index.move_to_end(skey)
+        return value, expires
+
+    def store_insert(self, key, value):
+        try:
+            data = pickle.dumps((key, value), pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return
+        skey = self._store_key(key)
+        # the disk tier is best effort: the value is still returned.
+        try:
+            with udon.content.writer(self.store.path(skey)) as fp:
+                if self.delay is not None:
+                    fp.write_header("Expires", "%.3f" % (time.time() + self.delay))
+                fp.write(data)
+        except OSError:
+            logging.getLogger(__name__).exception("failed to store %r", key)
+            return
+        with self.lock:
+            self.index[skey] = None
+            self.index.move_to_end(skey)
+            evicted = self.do_store_trim()
+        for skey in evicted:
+            self._store_delete(skey)
+
+    def store_remove(self, skey):
+        with self.lock:
+            self.index.pop(skey, None)
+        self._store_delete(skey)
+
+    def do_store_trim(self):
+        # return the least recently used keys over the limit, to be
+        # deleted once the lock is released.
+        evicted = []
+        while len(self.index) > self.store_size:
+            skey, _ = self.index.popitem(last = False)
+            evicted.append(skey)
+        return evicted
+
+    def _store_delete(self, skey):
+        try:
+            self.store.delete(skey)
+        except KeyError:
+            pass
+
+    def clear(self):
+        with self.lock:
+            skeys = list(self.index)
+            self.do_clear()
+        for skey in skeys:
+            self._store_delete(skey)
+
+    def do_clear(self):
+        super().do_clear()
+        self.index.clear()
+        self.promoted.clear()
+
+
+class _Batch(_Flight):
+    """
+    A batch of keys being loaded.
+    """
+
+    __slots__ = "keys",
+
+    def __init__(self):
+        super().__init__()
+        self.keys = []
+
+
+class BatchCache(LRUCache):
+    """
+    LRU cache for a batch loader: func(keys) returns a dict of the
+    values it found.  The misses of a get_many() call are loaded in a
+    single call, with at most 'max_batch' keys.  With a window, the
+    call is delayed for that many seconds and the misses of other
+    callers during that time are merged into it.
+    """
+
+    collecting = None
+
+    def __init__(self, func, size, window = 0, max_batch = None, lock = None):
+        if window and lock is None:
+            lock = threading.Lock()
+        super().__init__(func, size, lock = lock)
+        self.window = window
+        self.max_batch = max_batch
+
+    def __call__(self, key):
+        return self.get_many([ key ])[key]
+
+    def get_many(self, keys):
+        result = {}
+        leading = []
+        waiting = []
+        with self.lock:
+            for key in keys:
+                if key in result:
+                    continue
+                try:
+                    result[key] = self.do_lookup(key)
+                except KeyError:
+                    pass
+                else:
+                    self.hit += 1
+                    continue
+                batch = self.flights.get(key)
+                if batch is not None:
+                    self.hit += 1
+                else:
+                    self.miss += 1
+                    if self.window:
+                        batch = self.collecting
+                    else:
+                        batch = leading[-1] if leading else None
+                    if batch is None or (self.max_batch is not None and
+                                         len(batch.keys) >= self.max_batch):
+                        batch = _Batch()
+                        leading.append(batch)
+                        if self.window:
+                            self.collecting = batch
+                    batch.keys.append(key)
+                    self.flights[key] = batch
+                if batch not in waiting:
+                    waiting.append(batch)
+
+        if leading:
+            if self.window:
+                time.sleep(self.window)
+            for batch in leading:
+                self.do_load(batch)
+
+        for batch in waiting:
+            values = batch.wait()
+            for key in keys:
+                if key in values:
+                    result[key] = values[key]
+        return result
+
+    def do_load(self, batch):
+        with self.lock:
+            if self.collecting is batch:
+                self.collecting = None
+            keys = list(batch.keys)
+        t0 = time.perf_counter()
+        try:
+            values = self.func(keys)
+            self._computed(t0)
+            with self.lock:
+                try:
+                    for key in keys:
+                        if key in values:
+                            self.do_insert(key, values[key])
+                finally:
+                    for key in keys:
+                        del self.flights[key]
+        except BaseException as exc:
+            with self.lock:
+                for key in keys:
+                    self.flights.pop(key, None)
+            batch.set_error(exc)
+            return
+        batch.set_result(values)
+
+    def do_recompute(self, keys, workers):
+        # saved keys are loaded in batches, not one by one.
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+        futures = [ executor.submit(self.get_many, keys) ]
+        executor.shutdown(wait = False)
+        return futures
+
+
+def batch_cache(size, window = 0, max_batch = None, lock = None):
+    def _(func):
+        return BatchCache(func, size, window = window, max_batch = max_batch, lock = lock)
+    return _
+
+
 class DelayCache(AbstractCache):
+    """
+    Cache values for a given delay, or for the delay returned by
+    ttl(key, value) if set.  Expired entries are reclaimed as they
+    reach the top of a heap ordered by expiration time.  If size is
+    set, the entries closest to expiration are evicted first.
+
+    Expired values are still returned for 'stale' seconds while they
+    are recomputed in the background.  With 'refresh' set, values are
+    also recomputed when they are used less than 'refresh' seconds
+    before they expire.  At most 'max_refresh' values are recomputed
+    at the same time, on the given executor or on a thread pool, and
+    the cache then gets a lock if none is given.
+    """
 
-    def __init__(self, func, delay, lock = None):
+    refreshes = 0
+
+    def __init__(self, func, delay, lock = None, ttl = None, size = None,
+                 stale = 0, refresh = None, max_refresh = 4, executor = None):
+        # background refreshes insert values from other threads.
+        if (stale or refresh is not None) and lock is None:
+            lock = threading.Lock()
         super().__init__(func, lock = lock)
         self.delay = delay
+        self.ttl = ttl
+        self.size = size
+        self.stale = stale
+        self.refresh = refresh
+        self.max_refresh = max_refresh
+        self.executor = executor
+        self.refreshing = set()
         self.mapping = {}
-        self.next_purge = time.time() + delay
+        self.heap = []
+        self.counter = itertools.count()
 
-    def do_purge(self):
-        now = time.time()
-        self.mapping = { key: (timeout, data)
-                         for key, (timeout, data) in self.mapping.items()
-                         if timeout > now }
-        self.next_purge = now + self.delay
+    def do_purge(self, now):
+        # heap entries of replaced values are discarded on the way.
+        heap, mapping = self.heap, self.mapping
+        limit = now - self.stale
+        while heap and heap[0][0] <= limit:
+            timeout, _, key = heapq.heappop(heap)
+            entry = mapping.get(key)
+            if entry is not None and entry[0] == timeout:
+                del mapping[key]
+                self._expired()
 
     def do_size(self):
-        if time.time() > self.next_purge:
-            self.do_purge()
+        self.do_purge(time.monotonic())
         return len(self.mapping)
 
-    def do_get(self, *key):
-        if time.time() > self.next_purge:
-            self.do_purge()
-        timeout, data = self.mapping.get(key, (0, None))
-        if timeout < time.time():
-            self.miss += 1
-            data = self.do_compute(*key)
-            self.mapping[key] = time.time() + self.delay, data
+    def do_lookup(self, key):
+        now = time.monotonic()
+        self.do_purge(now)
+        timeout, value = self.mapping[key]
+        if now >= timeout or (self.refresh is not None and now >= timeout - self.refresh):
+            self.do_refresh(key)
+        return value
+
+    def do_refresh(self, key):
+        if key in self.refreshing or len(self.refreshing) >= self.max_refresh:
+            return
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.max_refresh)
+        self.refreshing.add(key)
+        self.refreshes += 1
+        self.executor.submit(self._refresh, key)
+
+    def _refresh(self, key):
+        t0 = time.perf_counter()
+        try:
+            value = self.do_compute(*key)
+        except NoCache:
+            with self.lock:
+                self.skip += 1
+        except Exception:
+            logging.getLogger(__name__).exception("failed to refresh %r", key)
         else:
-            self.hit += 1
-        return data
+            self._computed(t0)
+            with self.lock:
+                self.do_insert(key, value)
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def do_insert(self, key, value):
+        delay = self.delay if self.ttl is None else self.ttl(key, value)
+        if delay <= 0:
+            self.skip += 1
+            return
+        self._insert(key, value, time.monotonic() + delay)
+
+    def _insert(self, key, value, timeout):
+        if self.size is not None and key not in self.mapping:
+            while len(self.mapping) >= self.size:
+                self.do_evict()
+        self.mapping[key] = timeout, value
+        heapq.heappush(self.heap, (timeout, next(self.counter), key))
+
+    def do_evict(self):
+        # heap entries of replaced values are discarded on the way.
+        while self.heap:
+            timeout, _, key = heapq.heappop(self.heap)
+            entry = self.mapping.get(key)
+            if entry is not None and entry[0] == timeout:
+                del self.mapping[key]
+                self._evicted()
+                return
 
     def do_clear(self):
         self.mapping.clear()
+        self.heap.clear()
+
+    def do_items(self):
+        # the entries expiring last are the most recently computed.
+        self.do_purge(time.monotonic())
+        entries = sorted(self.mapping.items(), key = lambda item: item[1][0], reverse = True)
+        for key, (_, value) in entries:
+            yield key, value
+
+    def do_save(self, values):
+        # expiration times are saved as wall-clock time.
+        if not values:
+            yield from super().do_save(values)
+            return
+        offset = time.time() - time.monotonic()
+        self.do_purge(time.monotonic())
+        entries = sorted(self.mapping.items(), key = lambda item: item[1][0], reverse = True)
+        for key, (timeout, value) in entries:
+            yield key, value, timeout + offset
+
+    def do_restore(self, key, value, expires = None):
+        # values saved without an expiration time get a full delay.
+        if expires is None:
+            return super().do_restore(key, value)
+        now = time.monotonic()
+        self.do_purge(now)
+        if key in self.mapping:
+            return
+        remaining = expires - time.time()
+        if remaining <= 0:
+            self._expired()
+            return
+        self._insert(key, value, now + remaining)
+
+
+def delay_cache(delay, lock = None, ttl = None, size = None, **kwargs):
+    def _(func):
+        return DelayCache(func, delay, lock = lock, ttl = ttl, size = size, **kwargs)
+    return _
+
+
+class AsyncCacheMixin:
+    """
+    Cache the results of a coroutine function.  Concurrent misses for
+    the same key share a single computation.  The cache can be shared
+    by event loops running in different threads: the lock is never
+    held across an await, and the pending computations are plain
+    concurrent futures that every loop can wait for.
+    """
+
+    async def __call__(self, *key):
+        while True:
+            with self.lock:
+                try:
+                    value = self.do_lookup(key)
+                except KeyError:
+                    pass
+                else:
+                    self.hit += 1
+                    return value
+                future = concurrent.futures.Future()
+                pending = self.flights.setdefault(key, future)
+                if pending is future:
+                    self.miss += 1
+                    break
+            # do not propagate our own cancellation to the computation.
+            await asyncio.wait([ asyncio.wrap_future(pending) ])
+            if not pending.cancelled():
+                with self.lock:
+                    self.hit += 1
+                return pending.result()
+            # the computing task was cancelled, try again.
+
+        t0 = time.perf_counter()
+        try:
+            value = await self.do_compute(*key)
+        except NoCache as res:
+            with self.lock:
+                self.skip += 1
+                del self.flights[key]
+            future.set_result(res.value)
+            return res.value
+        except asyncio.CancelledError:
+            with self.lock:
+                del self.flights[key]
+            future.cancel()
+            raise
+        except BaseException as exc:
+            with self.lock:
+                del self.flights[key]
+            future.set_exception(exc)
+            raise
+        self._computed(t0)
+
+        try:
+            with self.lock:
+                try:
+                    self.do_insert(key, value)
+                finally:
+                    del self.flights[key]
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        future.set_result(value)
+        return value
+
+    def do_recompute(self, keys, workers):
+        # the saved keys are computed by tasks of the running loop.
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            raise RuntimeError("preload() of an async cache needs a running event loop") from None
+        semaphore = asyncio.Semaphore(workers)
+        async def _(key):
+            async with semaphore:
+                return await self(*key)
+        return [ loop.create_task(_(key)) for key in keys ]
+
+
+class AsyncLRUCache(AsyncCacheMixin, LRUCache):
+
+    def __init__(self, func, size):
+        super().__init__(func, size, lock = threading.Lock())
+
+
+def async_lru_cache(size):
+    def _(func):
+        if not inspect.iscoroutinefunction(func):
+            raise TypeError("not a coroutine function")
+        return AsyncLRUCache(func, size)
+    return _
+
+
+class AsyncDelayCache(AsyncCacheMixin, DelayCache):
+    """
+    Background refreshes run as tasks on the event loop.
+    """
+
+    def __init__(self, func, delay, ttl = None, size = None,
+                 stale = 0, refresh = None, max_refresh = 4):
+        super().__init__(func, delay, lock = threading.Lock(), ttl = ttl, size = size,
+                         stale = stale, refresh = refresh, max_refresh = max_refresh)
+        # keep a reference to the running tasks, or they may be
+        # garbage collected before they complete.
+        self.tasks = set()
+
+    def do_refresh(self, key):
+        if key in self.refreshing or len(self.refreshing) >= self.max_refresh:
+            return
+        self.refreshing.add(key)
+        self.refreshes += 1
+        task = asyncio.ensure_future(self._refresh(key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _refresh(self, key):
+        t0 = time.perf_counter()
+        try:
+            value = await self.do_compute(*key)
+        except NoCache:
+            with self.lock:
+                self.skip += 1
+        except Exception:
+            logging.getLogger(__name__).exception("failed to refresh %r", key)
+        else:
+            self._computed(t0)
+            with self.lock:
+                self.do_insert(key, value)
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
 
 
-def delay_cache(delay, lock = None):
+def async_delay_cache(delay, ttl = None, size = None, **kwargs):
     def _(func):
-        return DelayCache(func, delay, lock = lock)
+        if not inspect.iscoroutinefunction(func):
+            raise TypeError("not a coroutine function")
+        return AsyncDelayCache(func, delay, ttl = ttl, size = size, **kwargs)
     return _
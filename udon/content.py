@@ -14,12 +14,19 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 #
 
+import asyncio
 import collections
+import concurrent.futures
 import contextlib
 import hashlib
 import os
 import time
+import zlib
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 import udon.path
 
@@ -27,25 +34,69 @@ import udon.path
 ContentInfo = collections.namedtuple('ContentInfo', ['size', 'timestamp', 'offset', 'sha256', 'headers' ])
 
 
+class _GzipCompressor:
+
+    suffix = ".gz"
+
+    def __init__(self):
+        self.zobj = zlib.compressobj(9, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.zobj.compress(data)
+
+    def flush(self):
+        return self.zobj.flush()
+
+
+class _BrotliCompressor:
+
+    suffix = ".br"
+
+    def __init__(self):
+        self.bobj = brotli.Compressor()
+
+    def compress(self, data):
+        return self.bobj.process(data)
+
+    def flush(self):
+        return self.bobj.finish()
+
+
+_COMPRESSORS = { 'gzip': _GzipCompressor }
+if brotli is not None:
+    _COMPRESSORS['br'] = _BrotliCompressor
+
+# Encodings for which variants can be produced, by order of preference.
+ENCODINGS = tuple(enc for enc in ('br', 'gzip') if enc in _COMPRESSORS)
+
+
+def read_info(fp):
+    """
+    Parse the headers at the current position of a stream, and return
+    the content info. The stream is left at the start of the body.
+    """
+    info = {}
+    headers = []
+    while True:
+        line = fp.readline()
+        if line == b'\n':
+            break
+        key, value = line.split(b':', 1)
+        value = value.strip()
+        if key == b'Timestamp':
+            info['timestamp'] = int(value)
+        elif key == b'Size':
+            info['size'] = int(value)
+        elif key == b'Checksum-SHA256':
+            info['sha256'] = value.decode()
+        headers.append((key.decode(), value.decode('utf-8')))
+    return ContentInfo(headers = headers, offset = fp.tell(), **info)
+
+
 def reader(path):
     fp = open(path, "rb")
     try:
-        info = {}
-        headers = []
-        while True:
-            line = fp.readline()
-            if line == b'\n':
-                break
-            key, value = line.split(b':', 1)
-            value = value.strip()
-            if key == b'Timestamp':
-                info['timestamp'] = int(value)
-            elif key == b'Size':
-                info['size'] = int(value)
-            elif key == b'Checksum-SHA256':
-                info['sha256'] = value.decode()
-            headers.append((key.decode(), value.decode('utf-8')))
-        fp.info = ContentInfo(headers = headers, offset = fp.tell(), **info)
+        fp.info = read_info(fp)
         assert os.fstat(fp.fileno()).st_size == fp.info.size + fp.info.offset
     except:
         fp.close()
@@ -53,17 +104,64 @@ def reader(path):
     return fp
 
 
+def variant_path(path, encoding):
+    return path + _COMPRESSORS[encoding].suffix
+
+
+def variants(fp):
+    """
+    Return the list of encoded variants recorded for an open content.
+    """
+    for key, value in fp.info.headers:
+        if key == 'Content-Variants':
+            return value.split()
+    return []
+
+
+def variant_reader(fp, encoding):
+    """
+    Open the variant of an open content for the given encoding.
+    Raise KeyError if the variant does not exist or does not match
+    the content.
+    """
+    if encoding not in variants(fp):
+        raise KeyError(encoding)
+    try:
+        vfp = reader(variant_path(fp.name, encoding))
+    except FileNotFoundError:
+        raise KeyError(encoding)
+    headers = dict(vfp.info.headers)
+    if (headers.get('Content-Encoding') != encoding or
+        headers.get('Identity-Checksum-SHA256') != fp.info.sha256):
+        vfp.close()
+        raise KeyError(encoding)
+    return vfp
+
+
 @contextlib.contextmanager
-def writer(path, expect_size = None, tmpdir = None):
-    with udon.path.overwriting(path, tmpdir = tmpdir) as fp:
+def writer(path, expect_size = None, tmpdir = None, encodings = ()):
+    for encoding in encodings:
+        if encoding not in _COMPRESSORS:
+            raise ValueError("Unsupported encoding \"%s\"" % encoding)
+    with contextlib.ExitStack() as stack:
+        fp = stack.enter_context(udon.path.overwriting(path, tmpdir = tmpdir))
         wrt = _ContentWriter(fp, expect_size = expect_size)
+        for encoding in encodings:
+            vfp = stack.enter_context(udon.path.overwriting(variant_path(path, encoding), tmpdir = tmpdir))
+            wrt.add_variant(encoding, _ContentWriter(vfp))
         yield wrt
         wrt.close()
+    # drop the variants that did not make it, or stale ones.
+    for encoding in set(encodings).difference(wrt.variants()):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(variant_path(path, encoding))
 
 
 class _ContentWriter:
 
     RESERVED_HDRS = set(("Checksum-SHA256",
+                         "Content-Variants",
+                         "Identity-Checksum-SHA256",
                          "Size",
                          "Timestamp"))
     MAX_KEY_LEN = 128
@@ -80,6 +178,16 @@ class _ContentWriter:
         self.timestamp = int(time.time())
         self.fp = fp
         self._headers = {}
+        self._variants = []
+        self._encoding = None
+
+    def add_variant(self, encoding, wrt):
+        assert not self._headers
+        wrt._encoding = encoding
+        self._variants.append((encoding, _COMPRESSORS[encoding](), wrt))
+
+    def variants(self):
+        return [ encoding for encoding, _, _ in self._variants ]
 
     def write(self, data):
         if not self._headers_done:
@@ -87,6 +195,8 @@ class _ContentWriter:
         self.cksum.update(data)
         self.fp.write(data)
         self.size += len(data)
+        for _, compressor, wrt in self._variants:
+            wrt.write(compressor.compress(data))
 
     def write_header(self, hdr, value):
         assert not self._headers_done
@@ -103,7 +213,11 @@ class _ContentWriter:
             raise ValueError("Key must not contain '\n'")
         if hdr in self.RESERVED_HDRS:
             raise ValueError("Reserved header")
+        if hdr == "Content-Encoding" and (self._variants or self._encoding is not None):
+            raise ValueError("Content-Encoding is set on variants")
         self._write_header(hdr, value)
+        for _, _, wrt in self._variants:
+            wrt.write_header(hdr, value)
 
     def update_header(self, hdr, value):
         offset, size = self._headers[hdr]
@@ -121,10 +235,24 @@ class _ContentWriter:
             self._end_headers()
         self.update_header("Checksum-SHA256", self.cksum.hexdigest())
         self.update_header("Size", self.size)
+        if self._variants:
+            self._close_variants()
         self.fp.close()
         if self.expect_size not in (None, self.size):
             raise ValueError("Content has incorrect size")
 
+    def _close_variants(self):
+        variants = []
+        for encoding, compressor, wrt in self._variants:
+            wrt.write(compressor.flush())
+            wrt.update_header("Identity-Checksum-SHA256", self.cksum.hexdigest())
+            wrt.close()
+            # only keep the variants that are worth it.
+            if wrt.size < self.size:
+                variants.append((encoding, compressor, wrt))
+        self._variants = variants
+        self.update_header("Content-Variants", " ".join(self.variants()))
+
     def _coerce_value(self, value):
         if not isinstance(value, bytes):
             value = str(value).encode('utf-8')
@@ -138,6 +266,11 @@ class _ContentWriter:
         self._write_header("Checksum-SHA256", self.cksum.hexdigest())
         self._write_header("Size", self.MAX_SIZE)
         self._write_header("Timestamp", self.timestamp)
+        if self._variants:
+            self._write_header("Content-Variants", " ".join(self.variants()))
+        if self._encoding is not None:
+            self._write_header("Content-Encoding", self._encoding)
+            self._write_header("Identity-Checksum-SHA256", self.cksum.hexdigest())
 
     def _write_header(self, header, value):
         hdr = b"%s: " % header.encode('utf-8')
@@ -154,3 +287,82 @@ class _ContentWriter:
         self.fp.write(b"\n")
         self.wpos += 1
         self._headers_done = True
+
+
+_executor = None
+def set_executor(executor):
+    """
+    Set the executor on which the file operations of asynchronous
+    readers and writers are run.
+    """
+    global _executor
+    _executor = executor
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers = 4)
+    return _executor
+
+async def _run(func, *args):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_get_executor(), func, *args)
+
+
+async def areader(path):
+    return _AsyncContentReader(await _run(reader, path))
+
+
+def awriter(path, expect_size = None, tmpdir = None, encodings = ()):
+    return _AsyncContentWriter(writer(path,
+                                      expect_size = expect_size,
+                                      tmpdir = tmpdir,
+                                      encodings = encodings))
+
+
+class _AsyncContentReader:
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.info = fp.info
+        self.name = fp.name
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, _type, _value, _traceback):
+        await self.close()
+
+    async def __aiter__(self):
+        while True:
+            chunk = await self.read(2 ** 16)
+            if not chunk:
+                break
+            yield chunk
+
+    async def read(self, size = -1):
+        return await _run(self.fp.read, size)
+
+    async def close(self):
+        await _run(self.fp.close)
+
+
+class _AsyncContentWriter:
+
+    wrt = None
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+
+    async def __aenter__(self):
+        self.wrt = await _run(self.ctx.__enter__)
+        return self
+
+    async def __aexit__(self, _type, _value, _traceback):
+        return await _run(self.ctx.__exit__, _type, _value, _traceback)
+
+    async def write(self, data):
+        await _run(self.wrt.write, data)
+
+    async def write_header(self, hdr, value):
+        await _run(self.wrt.write_header, hdr, value)
@@ -14,7 +14,15 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 #
 
+import array
+import asyncio
+import contextlib
 import heapq
+import math
+import queue
+import random
+import threading
+import time
 
 
 class PriorityQueue:
@@ -53,6 +61,271 @@ class PriorityQueue:
             yield item, priority
 
 
+class IndexedPriorityQueue:
+    """
+    Priority queue which tracks the position of each item in the heap,
+    so that items can be updated or removed in O(log n).  Items must be
+    hashable, and they are unique in the queue.  Items with the same
+    priority are popped in insertion order, and never compared.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.position = {}
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __bool__(self):
+        return bool(self.heap)
+
+    def __contains__(self, item):
+        return item in self.position
+
+    def _sift_up(self, pos):
+        heap, position = self.heap, self.position
+        entry = heap[pos]
+        key = entry[0], entry[1]
+        while pos:
+            parent = (pos - 1) >> 1
+            other = heap[parent]
+            if key >= (other[0], other[1]):
+                break
+            heap[pos] = other
+            position[other[2]] = pos
+            pos = parent
+        heap[pos] = entry
+        position[entry[2]] = pos
+
+    def _sift_down(self, pos):
+        heap, position = self.heap, self.position
+        size = len(heap)
+        entry = heap[pos]
+        key = entry[0], entry[1]
+        while True:
+            child = 2 * pos + 1
+            if child >= size:
+                break
+            other = heap[child]
+            if child + 1 < size:
+                right = heap[child + 1]
+                if (right[0], right[1]) < (other[0], other[1]):
+                    child += 1
+                    other = right
+            if key <= (other[0], other[1]):
+                break
+            heap[pos] = other
+            position[other[2]] = pos
+            pos = child
+        heap[pos] = entry
+        position[entry[2]] = pos
+
+    def _remove_at(self, pos):
+        heap = self.heap
+        entry = heap[pos]
+        del self.position[entry[2]]
+        last = heap.pop()
+        if pos < len(heap):
+            heap[pos] = last
+            self.position[last[2]] = pos
+            self._sift_up(pos)
+            self._sift_down(self.position[last[2]])
+        return entry
+
+    def insert(self, item, priority):
+        """
+        Insert an item, or change its priority if already queued.
+        """
+        if item in self.position:
+            self.update(item, priority)
+            return
+        self.counter += 1
+        self.heap.append([ priority, self.counter, item ])
+        self._sift_up(len(self.heap) - 1)
+
+    def update(self, item, priority):
+        pos = self.position[item]
+        entry = self.heap[pos]
+        old, entry[0] = entry[0], priority
+        if priority < old:
+            self._sift_up(pos)
+        else:
+            self._sift_down(pos)
+
+    def priority(self, item):
+        return self.heap[self.position[item]][0]
+
+    def remove(self, item):
+        self._remove_at(self.position[item])
+
+    def discard(self, item):
+        if item in self.position:
+            self.remove(item)
+
+    def clear(self):
+        self.heap.clear()
+        self.position.clear()
+
+    def peek(self):
+        priority, _, item = self.heap[0]
+        return item, priority
+
+    def pop(self):
+        if not self.heap:
+            raise IndexError("pop from empty priority queue")
+        priority, _, item = self._remove_at(0)
+        return item, priority
+
+    def pop_until(self, priority_max):
+        while self.heap:
+            if self.heap[0][0] > priority_max:
+                break
+            yield self.pop()
+
+    def __iter__(self):
+        while self.heap:
+            yield self.pop()
+
+
+class TimerWheel:
+    """
+    Hierarchical timer wheel.  Deadlines are rounded up to ticks of
+    'resolution', and placed in one of the wheels depending on how
+    far they are from the current tick.  Each time a wheel completes
+    a turn, the next slot of the upper wheel is spread over the lower
+    ones.  Insert and cancel are O(1).  Items must be hashable, and
+    they are unique in the wheel.
+    """
+
+    BITS = 8
+    LEVELS = 4
+
+    def __init__(self, resolution = .001, start = 0):
+        self.resolution = resolution
+        self.current = int(start / resolution)
+        self.slots = 1 << self.BITS
+        self.mask = self.slots - 1
+        # one bucket per slot of each wheel, and one for overflow.
+        self.buckets = [ {} for _ in range(self.slots * self.LEVELS + 1) ]
+        self.counts = [ 0 ] * (self.LEVELS + 1)
+        self.where = {}
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.where)
+
+    def __bool__(self):
+        return bool(self.where)
+
+    def __contains__(self, item):
+        return item in self.where
+
+    def _place(self, item, entry):
+        tick = entry[0]
+        delta = tick - self.current
+        if delta < 0:
+            tick, delta = self.current, 0
+        level = (delta.bit_length() - 1) // self.BITS if delta else 0
+        if level < self.LEVELS:
+            pos = level * self.slots + ((tick >> (self.BITS * level)) & self.mask)
+        else:
+            level, pos = self.LEVELS, self.LEVELS * self.slots
+        self.buckets[pos][item] = entry
+        self.counts[level] += 1
+        self.where[item] = pos
+
+    def insert(self, item, deadline):
+        """
+        Schedule an item, or reschedule it if already in the wheel.
+        """
+        if item in self.where:
+            self.cancel(item)
+        self.counter += 1
+        tick = math.ceil(deadline / self.resolution)
+        self._place(item, (tick, deadline, self.counter))
+
+    def cancel(self, item):
+        pos = self.where.pop(item)
+        del self.buckets[pos][item]
+        self.counts[pos // self.slots] -= 1
+
+    def discard(self, item):
+        if item in self.where:
+            self.cancel(item)
+
+    def clear(self):
+        for bucket in self.buckets:
+            bucket.clear()
+        self.where.clear()
+        self.counts = [ 0 ] * (self.LEVELS + 1)
+
+    def _cascade(self):
+        # find the highest wheel which completed a turn, and spread
+        # its current slot, then the ones below, on the lower wheels.
+        top = 0
+        while top < self.LEVELS and not self.current & ((1 << (self.BITS * (top + 1))) - 1):
+            top += 1
+        for level in range(top, 0, -1):
+            pos = level * self.slots
+            if level < self.LEVELS:
+                pos += (self.current >> (self.BITS * level)) & self.mask
+            bucket = self.buckets[pos]
+            if not bucket:
+                continue
+            entries = list(bucket.items())
+            bucket.clear()
+            self.counts[level] -= len(entries)
+            for item, entry in entries:
+                self._place(item, entry)
+
+    def _advance(self, target):
+        # skip to the next tick where the lowest non-empty wheel may
+        # have due items, but not beyond the target.
+        level = 0
+        while level < self.LEVELS and not self.counts[level]:
+            level += 1
+        if level == 0:
+            step = 1
+        elif level == self.LEVELS and not self.counts[level]:
+            self.current = target
+            return
+        else:
+            step = 1 << (self.BITS * level)
+        following = (self.current // step + 1) * step if level else self.current + 1
+        if following > target:
+            self.current = target
+            return
+        self.current = following
+        if not following & self.mask:
+            self._cascade()
+
+    def pop_until(self, now):
+        """
+        Remove and yield the (item, deadline) pairs which are due at
+        time 'now', in deadline order.
+        """
+        target = int(now / self.resolution) + 1
+        while True:
+            if self.counts[0]:
+                # the current slot also holds the items inserted in the
+                # past, and items may be cancelled or added meanwhile.
+                bucket = self.buckets[self.current & self.mask]
+                while True:
+                    entries = sorted((entry, item) for item, entry in bucket.items()
+                                     if entry[0] < target)
+                    if not entries:
+                        break
+                    for entry, item in entries:
+                        if bucket.get(item) is not entry:
+                            continue
+                        self.cancel(item)
+                        yield item, entry[1]
+            if self.current >= target:
+                break
+            self._advance(target)
+
+
 _UNDEFINED = object()
 class DListNode:
 
@@ -170,3 +443,544 @@ class DoublyLinkedList:
         while node is not self.head:
             yield node.item
             node = node.prev
+
+
+class CompactDoublyLinkedList:
+    """
+    Doubly-linked list with the same interface as DoublyLinkedList,
+    but the links are kept in arrays and the nodes are integer handles.
+    Handle 0 is the sentinel, both head and tail.  The handles of
+    removed entries are reused.
+    """
+
+    head = tail = 0
+
+    def __init__(self, entries = ()):
+        self.prev = array.array('l', [ 0 ])
+        self.next = array.array('l', [ 0 ])
+        self.items = [ None ]
+        self.free = 0
+        self.size = 0
+        for entry in entries:
+            self.insert_tail(entry)
+
+    def _alloc(self, entry):
+        node = self.free
+        if node:
+            self.free = self.next[node]
+            self.items[node] = entry
+        else:
+            node = len(self.items)
+            self.prev.append(0)
+            self.next.append(0)
+            self.items.append(entry)
+        return node
+
+    def _remove_node(self, node):
+        prev, next = self.prev, self.next
+        next[prev[node]] = next[node]
+        prev[next[node]] = prev[node]
+        item = self.items[node]
+        self.items[node] = None
+        next[node] = self.free
+        self.free = node
+        self.size -= 1
+        return item
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return bool(self.size)
+
+    def peek_head(self):
+        if not self.size:
+            raise IndexError("peek from empty doubly-linked list")
+        return self.items[self.next[0]]
+
+    def pop_head(self):
+        if not self.size:
+            raise IndexError("pop from empty doubly-linked list")
+        return self._remove_node(self.next[0])
+
+    def pop_head_n(self, count):
+        for _ in range(count):
+            try:
+                yield self.pop_head()
+            except IndexError:
+                break
+
+    def peek_tail(self):
+        if not self.size:
+            raise IndexError("peek from empty doubly-linked list")
+        return self.items[self.prev[0]]
+
+    def pop_tail(self):
+        if not self.size:
+            raise IndexError("pop from empty doubly-linked list")
+        return self._remove_node(self.prev[0])
+
+    def pop_tail_n(self, count):
+        for _ in range(count):
+            try:
+                yield self.pop_tail()
+            except IndexError:
+                break
+
+    def remove(self, node):
+        self._remove_node(node)
+
+    def insert_after(self, entry, node_prev):
+        node = self._alloc(entry)
+        prev, next = self.prev, self.next
+        prev[node] = node_prev
+        next[node] = node_next = next[node_prev]
+        next[node_prev] = prev[node_next] = node
+        self.size += 1
+        return node
+
+    def insert_before(self, entry, node_next):
+        return self.insert_after(entry, self.prev[node_next])
+
+    def insert_head(self, entry):
+        return self.insert_after(entry, 0)
+
+    def insert_tail(self, entry):
+        return self.insert_after(entry, self.prev[0])
+
+    def __iter__(self):
+        next, items = self.next, self.items
+        node = next[0]
+        while node:
+            yield items[node]
+            node = next[node]
+
+    def __reversed__(self):
+        prev, items = self.prev, self.items
+        node = prev[0]
+        while node:
+            yield items[node]
+            node = prev[node]
+
+
+def _wake_up(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class BlockingPriorityQueue(PriorityQueue):
+    """
+    Priority queue shared by threads and coroutines.  Threads block
+    in pop() and insert(), coroutines await apop() and ainsert().  If
+    maxsize is set, producers wait for room in the queue.  When the
+    priorities are timestamps of the given clock, pop_due() and
+    apop_due() wait for the first item to be due.
+    """
+
+    def __init__(self, maxsize = 0, clock = time.time):
+        super().__init__()
+        self.maxsize = maxsize
+        self.clock = clock
+        self.cond = threading.Condition()
+        self.waiters = []
+
+    def _notify(self):
+        self.cond.notify_all()
+        waiters, self.waiters = self.waiters, []
+        for loop, future in waiters:
+            with contextlib.suppress(RuntimeError):
+                loop.call_soon_threadsafe(_wake_up, future)
+
+    # The delay functions return how long to wait before the action
+    # can be done: 0 for now, None for until something changes.
+
+    def _has_item(self):
+        return 0 if self.heap else None
+
+    def _has_due_item(self):
+        return max(0, self.heap[0][0] - self.clock()) if self.heap else None
+
+    def _has_room(self):
+        return None if 0 < self.maxsize <= len(self.heap) else 0
+
+    def _pop(self):
+        result = super().pop()
+        self._notify()
+        return result
+
+    def _insert(self, item, priority):
+        super().insert(item, priority)
+        self._notify()
+
+    def _block(self, delay, timeout, error):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = delay()
+            if wait == 0:
+                return
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise error
+                wait = remaining if wait is None else min(wait, remaining)
+            self.cond.wait(wait)
+
+    async def _ablock(self, delay, action, timeout, error):
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.cond:
+                wait = delay()
+                if wait == 0:
+                    return action()
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise error
+                    wait = remaining if wait is None else min(wait, remaining)
+                future = loop.create_future()
+                self.waiters.append((loop, future))
+            try:
+                await asyncio.wait([ future ], timeout = wait)
+            finally:
+                if not future.done():
+                    future.cancel()
+                    with self.cond:
+                        with contextlib.suppress(ValueError):
+                            self.waiters.remove((loop, future))
+
+    def insert(self, item, priority, timeout = None):
+        """
+        Insert an item, waiting for room in the queue, and raise
+        queue.Full if there is still none after 'timeout' seconds.
+        """
+        with self.cond:
+            self._block(self._has_room, timeout, queue.Full)
+            self._insert(item, priority)
+
+    def pop(self, timeout = None):
+        """
+        Pop the first item, waiting for one if the queue is empty, and
+        raise queue.Empty if there is still none after 'timeout' seconds.
+        """
+        with self.cond:
+            self._block(self._has_item, timeout, queue.Empty)
+            return self._pop()
+
+    def pop_due(self, timeout = None):
+        """
+        Pop the first item when it is due.
+        """
+        with self.cond:
+            self._block(self._has_due_item, timeout, queue.Empty)
+            return self._pop()
+
+    async def ainsert(self, item, priority, timeout = None):
+        await self._ablock(self._has_room,
+                           lambda: self._insert(item, priority),
+                           timeout, queue.Full)
+
+    async def apop(self, timeout = None):
+        return await self._ablock(self._has_item, self._pop, timeout, queue.Empty)
+
+    async def apop_due(self, timeout = None):
+        return await self._ablock(self._has_due_item, self._pop, timeout, queue.Empty)
+
+    def peek(self):
+        with self.cond:
+            return super().peek()
+
+    def pop_until(self, priority_max):
+        with self.cond:
+            result = list(super().pop_until(priority_max))
+            if result:
+                self._notify()
+        return iter(result)
+
+    def __iter__(self):
+        with self.cond:
+            result = list(super().__iter__())
+            if result:
+                self._notify()
+        return iter(result)
+
+
+class _SkipNode:
+
+    __slots__ = "key", "value", "next"
+
+    def __init__(self, key, value, level):
+        self.key = key
+        self.value = value
+        self.next = [ None ] * level
+
+
+class SortedMap:
+    """
+    Mapping ordered by key, implemented as a skip list.  Lookup, insert
+    and delete, as well as floor and ceiling queries, are O(log n) on
+    average.  Keys must be comparable with each other.
+    """
+
+    MAX_LEVEL = 32
+    P = .25
+
+    def __init__(self, items = ()):
+        self.head = _SkipNode(None, None, self.MAX_LEVEL)
+        self.level = 1
+        self.size = 0
+        self.random = random.Random()
+        if hasattr(items, "items"):
+            items = items.items()
+        for key, value in items:
+            self[key] = value
+
+    @classmethod
+    def from_sorted(cls, items):
+        """
+        Build a map from (key, value) pairs sorted by unique keys in
+        O(n), and raise ValueError if they are not.
+        """
+        self = cls()
+        tails = [ self.head ] * self.MAX_LEVEL
+        for key, value in items:
+            if self.size and not tails[0].key < key:
+                raise ValueError("keys are not sorted: %r" % (key, ))
+            level = self._random_level()
+            node = _SkipNode(key, value, level)
+            for i in range(level):
+                tails[i].next[i] = node
+                tails[i] = node
+            self.level = max(self.level, level)
+            self.size += 1
+        return self
+
+    def _random_level(self):
+        level = 1
+        while level < self.MAX_LEVEL and self.random.random() < self.P:
+            level += 1
+        return level
+
+    def _find(self, key, update = None):
+        # return the last node before the key, on each level if asked.
+        node = self.head
+        for i in range(self.level - 1, -1, -1):
+            following = node.next[i]
+            while following is not None and following.key < key:
+                node = following
+                following = node.next[i]
+            if update is not None:
+                update[i] = node
+        return node
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return bool(self.size)
+
+    def __contains__(self, key):
+        node = self._find(key).next[0]
+        return node is not None and node.key == key
+
+    def __getitem__(self, key):
+        node = self._find(key).next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        return node.value
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        update = [ self.head ] * self.MAX_LEVEL
+        node = self._find(key, update).next[0]
+        if node is not None and node.key == key:
+            node.value = value
+            return
+        level = self._random_level()
+        self.level = max(self.level, level)
+        node = _SkipNode(key, value, level)
+        for i in range(level):
+            node.next[i] = update[i].next[i]
+            update[i].next[i] = node
+        self.size += 1
+
+    def __delitem__(self, key):
+        update = [ self.head ] * self.MAX_LEVEL
+        node = self._find(key, update).next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        for i in range(len(node.next)):
+            update[i].next[i] = node.next[i]
+        while self.level > 1 and self.head.next[self.level - 1] is None:
+            self.level -= 1
+        self.size -= 1
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def clear(self):
+        self.head.next = [ None ] * self.MAX_LEVEL
+        self.level = 1
+        self.size = 0
+
+    def floor(self, key):
+        """
+        Return the (key, value) pair with the greatest key lower than
+        or equal to the given one, or raise KeyError.
+        """
+        node = self._find(key)
+        following = node.next[0]
+        if following is not None and following.key == key:
+            return following.key, following.value
+        if node is self.head:
+            raise KeyError(key)
+        return node.key, node.value
+
+    def ceiling(self, key):
+        """
+        Return the (key, value) pair with the smallest key greater than
+        or equal to the given one, or raise KeyError.
+        """
+        node = self._find(key).next[0]
+        if node is None:
+            raise KeyError(key)
+        return node.key, node.value
+
+    def first(self):
+        node = self.head.next[0]
+        if node is None:
+            raise KeyError("first in empty sorted map")
+        return node.key, node.value
+
+    def last(self):
+        node = self.head
+        for i in range(self.level - 1, -1, -1):
+            while node.next[i] is not None:
+                node = node.next[i]
+        if node is self.head:
+            raise KeyError("last in empty sorted map")
+        return node.key, node.value
+
+    def irange(self, start = None, stop = None):
+        """
+        Iterate over the (key, value) pairs with start <= key < stop.
+        """
+        node = self.head.next[0] if start is None else self._find(start).next[0]
+        while node is not None and (stop is None or node.key < stop):
+            yield node.key, node.value
+            node = node.next[0]
+
+    def items(self):
+        return self.irange()
+
+    def keys(self):
+        return (key for key, _ in self.irange())
+
+    def values(self):
+        return (value for _, value in self.irange())
+
+    def __iter__(self):
+        return self.keys()
+
+
+class RingBuffer:
+    """
+    Fixed-capacity byte ring buffer.  Producers fill the free space
+    with write(), readinto(), or write_views() followed by commit().
+    Consumers get the buffered data with read(), or read_views()
+    followed by consume().  The views are memoryviews over the buffer
+    itself: at most two, when the region wraps around.  They are only
+    valid until the next commit() or consume().
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return bool(self.size)
+
+    def free(self):
+        return self.capacity - self.size
+
+    def _views(self, offset, count):
+        end = offset + count
+        if not count:
+            return []
+        if end <= self.capacity:
+            return [ self.view[offset:end] ]
+        return [ self.view[offset:], self.view[:end - self.capacity] ]
+
+    def read_views(self):
+        return self._views(self.start, self.size)
+
+    def write_views(self):
+        return self._views((self.start + self.size) % self.capacity, self.free())
+
+    def commit(self, count):
+        if count > self.free():
+            raise ValueError("commit beyond free space")
+        self.size += count
+
+    def consume(self, count):
+        if count > self.size:
+            raise ValueError("consume beyond buffered data")
+        self.size -= count
+        # rewind when empty, to keep the free space contiguous.
+        self.start = (self.start + count) % self.capacity if self.size else 0
+
+    def write(self, data):
+        """
+        Copy as much of the data as fits, and return the count.
+        """
+        data = memoryview(data).cast('B')
+        count = 0
+        for view in self.write_views():
+            chunk = data[count:count + len(view)]
+            view[:len(chunk)] = chunk
+            count += len(chunk)
+        self.commit(count)
+        return count
+
+    def readinto(self, source):
+        """
+        Fill the free space with a single readinto() call on a file, or
+        recv_into() on a socket.  Return the count, 0 at end of file.
+        """
+        views = self.write_views()
+        if not views:
+            raise BufferError("ring buffer is full")
+        readinto = getattr(source, "readinto", None) or source.recv_into
+        count = readinto(views[0])
+        if count:
+            self.commit(count)
+        return count
+
+    def read(self, count = -1):
+        if count < 0 or count > self.size:
+            count = self.size
+        data = bytearray(count)
+        offset = 0
+        for view in self._views(self.start, count):
+            data[offset:offset + len(view)] = view
+            offset += len(view)
+        self.consume(count)
+        return bytes(data)
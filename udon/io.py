@@ -14,6 +14,9 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 #
 
+import udon.datastructure
+
+
 def chunks(source, chunk_size = 2 ** 16, expect_size = None):
     size = 0
     if isinstance(source, bytes):
@@ -28,3 +31,25 @@ def chunks(source, chunk_size = 2 ** 16, expect_size = None):
             size += len(chunk)
     if expect_size not in (size, None):
         raise ValueError('incorrect size')
+
+
+def views(source, chunk_size = 2 ** 16, expect_size = None):
+    """
+    Like chunks(), but read the source into a preallocated ring buffer
+    and yield memoryviews over it, instead of new bytes for each chunk.
+    A view is only valid until the next one is requested.
+    """
+    if isinstance(source, bytes):
+        yield from chunks(source, expect_size = expect_size)
+        return
+    ring = udon.datastructure.RingBuffer(chunk_size)
+    size = 0
+    while True:
+        if not ring.readinto(source):
+            break
+        for view in ring.read_views():
+            yield view
+            size += len(view)
+        ring.consume(len(ring))
+    if expect_size not in (size, None):
+        raise ValueError('incorrect size')
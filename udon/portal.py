@@ -15,12 +15,15 @@
 #
 
 import base64
+import itertools
 import json
+import math
 import threading
 import time
 
 import requests
 
+import udon.datastructure
 import udon.util
 
 
@@ -55,12 +58,20 @@ HTTPError = requests.exceptions.HTTPError
 class ExpireCache:
     def __init__(self):
         self.cache = {}
+        # (timeout, sequence) -> key, to find the expired keys.
+        self.expiry = udon.datastructure.SortedMap()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
 
     def purge(self, timestamp = None):
         if timestamp is None:
             timestamp = time.time()
-        for key in [ key for (key, (timeout, _)) in self.cache.items() if timeout <= timestamp ]:
-            del self.cache[key]
+        with self.lock:
+            self._purge(timestamp)
+
+    def _purge(self, timestamp):
+        for _, key in list(self.expiry.irange(stop = (timestamp, math.inf))):
+            self._unset(key)
 
     def __len__(self):
         return len(self.cache)
@@ -71,20 +82,30 @@ class ExpireCache:
     def get(self, key, timestamp = None):
         if timestamp is None:
             timestamp = time.time()
-        timeout, value = self.cache.get(key, (None, None))
-        if timeout is None:
-            raise KeyError(key)
-        if timeout <= timestamp:
-            del self.cache[key]
-            self.purge(timestamp)
-            raise ExpiredCredentials(key)
-        return value
+        with self.lock:
+            timeout, value, _ = self.cache.get(key, (None, None, None))
+            if timeout is None:
+                raise KeyError(key)
+            if timeout <= timestamp:
+                self._purge(timestamp)
+                raise ExpiredCredentials(key)
+            return value
 
     def set(self, key, value, timeout):
-        self.cache[key] = timeout, value
+        with self.lock:
+            if key in self.cache:
+                self._unset(key)
+            expiry = timeout, next(self.counter)
+            self.cache[key] = timeout, value, expiry
+            self.expiry[expiry] = key
 
     def unset(self, key):
-        del self.cache[key]
+        with self.lock:
+            self._unset(key)
+
+    def _unset(self, key):
+        _, _, expiry = self.cache.pop(key)
+        del self.expiry[expiry]
 
 
 class Portal:
@@ -0,0 +1,257 @@
+#
+# Copyright (c) 2019 Eric Faurot <eric@faurot.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+#
+# A segment is a single file packing many content records:
+#
+#   MAGIC
+#   record*       (keylen, size) key data
+#   index         (keylen, offset, size) key, for each record
+#   trailer       (index offset, record count) MAGIC
+#
+# Records are written and read sequentially, and the trailing index
+# gives random access to any of them.
+#
+
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import os
+import struct
+
+import udon.content
+import udon.io
+import udon.path
+import udon.store
+
+
+MAGIC = b"UDONSEG1"
+
+_RECORD = struct.Struct(">HQ")
+_INDEX = struct.Struct(">HQQ")
+_TRAILER = struct.Struct(">QQ8s")
+
+
+@contextlib.contextmanager
+def writer(path, tmpdir = None):
+    with udon.path.overwriting(path, tmpdir = tmpdir) as fp:
+        wrt = _SegmentWriter(fp)
+        yield wrt
+        wrt.close()
+
+
+class _SegmentWriter:
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.fp.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.index = []
+
+    def __len__(self):
+        return len(self.index)
+
+    def add(self, key, source, size = None):
+        if size is None:
+            if isinstance(source, bytes):
+                size = len(source)
+            else:
+                size = os.fstat(source.fileno()).st_size
+        bkey = key.encode('utf-8')
+        self.fp.write(_RECORD.pack(len(bkey), size))
+        self.fp.write(bkey)
+        self.offset += _RECORD.size + len(bkey)
+        self.index.append((bkey, self.offset, size))
+        for chunk in udon.io.views(source, expect_size = size):
+            self.fp.write(chunk)
+        self.offset += size
+
+    def close(self):
+        for bkey, offset, size in self.index:
+            self.fp.write(_INDEX.pack(len(bkey), offset, size))
+            self.fp.write(bkey)
+        self.fp.write(_TRAILER.pack(self.offset, len(self.index), MAGIC))
+        self.fp.close()
+
+
+class _RecordIO(io.RawIOBase):
+
+    def __init__(self, fd, offset, size):
+        self.fd = fd
+        self.start = offset
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.pos = max(0, min(offset, self.size))
+        return self.pos
+
+    def readinto(self, buf):
+        count = min(len(buf), self.size - self.pos)
+        if count <= 0:
+            return 0
+        data = os.pread(self.fd, count, self.start + self.pos)
+        buf[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+
+class SegmentReader:
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, "rb")
+        try:
+            self.index = self._read_index()
+        except:
+            self.fp.close()
+            raise
+
+    def _read_index(self):
+        if self.fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a segment file")
+        self.fp.seek(-_TRAILER.size, io.SEEK_END)
+        index_offset, count, magic = _TRAILER.unpack(self.fp.read(_TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError("Truncated segment file")
+        self.fp.seek(index_offset)
+        index = collections.OrderedDict()
+        for _ in range(count):
+            keylen, offset, size = _INDEX.unpack(self.fp.read(_INDEX.size))
+            index[self.fp.read(keylen).decode('utf-8')] = offset, size
+        return index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _type, _value, _traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        """
+        Stream all the records in file order, as (key, data) pairs.
+        """
+        self.fp.seek(len(MAGIC))
+        for key, (offset, size) in self.index.items():
+            if self.fp.tell() != offset:
+                self.fp.seek(offset)
+            yield key, self.fp.read(size)
+
+    def keys(self):
+        return self.index.keys()
+
+    def read(self, key):
+        offset, size = self.index[key]
+        return os.pread(self.fp.fileno(), size, offset)
+
+    def open(self, key):
+        """
+        Open a record for reading, without loading it in memory.
+        """
+        offset, size = self.index[key]
+        return io.BufferedReader(_RecordIO(self.fp.fileno(), offset, size))
+
+    def close(self):
+        self.fp.close()
+
+
+def reader(path):
+    return SegmentReader(path)
+
+
+def pack(store, prefix, segment_size = 2 ** 30, tmpdir = None):
+    """
+    Pack all the records of a store into segment files named after
+    the given prefix. Return the list of segment paths.
+    """
+    paths = []
+    keys = collections.deque(sorted(store.walk()))
+    while keys or not paths:
+        path = "%s.%04d" % (prefix, len(paths))
+        with writer(path, tmpdir = tmpdir) as wrt:
+            while keys and (not len(wrt) or wrt.offset < segment_size):
+                key = keys.popleft()
+                with store.open(key) as fp:
+                    wrt.add(key, fp)
+        paths.append(path)
+    return paths
+
+
+def verify(key, data, addressed = False):
+    """
+    Check that the data is a valid content record.  If addressed,
+    the key must also be the SHA-256 of the whole record.
+    """
+    info = udon.content.read_info(io.BytesIO(data))
+    body = memoryview(data)[info.offset:]
+    if len(body) != info.size:
+        raise ValueError("Record \"%s\" has incorrect size" % key)
+    if hashlib.sha256(body).hexdigest() != info.sha256:
+        raise ValueError("Record \"%s\" has incorrect checksum" % key)
+    if addressed and hashlib.sha256(data).hexdigest() != key:
+        raise ValueError("Record \"%s\" does not match its key" % key)
+    return key, data
+
+
+def unpack(paths, store, workers = None, max_pending = 64):
+    """
+    Import the records of the given segment files into a store of
+    any kind, under their recorded keys.  For a SHA256Store, the keys
+    must match the records.  Segments are read
+    sequentially, the records are checked in parallel and written in
+    order.  Return the number of records.
+    """
+    count = 0
+    pending = collections.deque()
+    # content-addressed keys are checked against the records.
+    addressed = isinstance(store, udon.store.SHA256Store)
+
+    def _commit():
+        key, data = pending.popleft().result()
+        store.insert(key, data)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+        for path in paths:
+            with reader(path) as rdr:
+                for key, data in rdr:
+                    pending.append(executor.submit(verify, key, data, addressed))
+                    if len(pending) >= max_pending:
+                        _commit()
+                    count += 1
+        while pending:
+            _commit()
+    return count
@@ -43,6 +43,12 @@ class AbstractStore(object):
         """
         return os.path.join(self.root, key[:2], key)
 
+    def path(self, key):
+        """
+        Return the path of the file holding the key.
+        """
+        return self._filename(key)
+
     def _dirname(self, key):
         """
         Construct the directory name for the key.
@@ -76,6 +82,22 @@ class AbstractStore(object):
         os.rename(tmppath, self._filename(key))
         return not exists
 
+    def insert(self, key, content):
+        """
+        Write the content under the given key, which must be valid for
+        this store.  Return True if the key did not exist before.
+        """
+        if not self.is_key(key):
+            raise ValueError("Invalid key for store: %r" % key)
+        fp, tmppath = self._tempfile()
+        try:
+            with fp:
+                fp.write(content)
+        except:
+            os.unlink(tmppath)
+            raise
+        return self._commit(key, tmppath)
+
     def delete(self, key):
         """
         Remove the key
@@ -1,7 +1,16 @@
+import asyncio
+import gc
+import multiprocessing
+import os
+import tempfile
 import unittest
+import threading
 import time
 
+import udon.asynchronous
 import udon.cache
+import udon.store
+import udon.util
 
 
 class TestCache(unittest.TestCase):
@@ -62,3 +71,722 @@ class TestCache(unittest.TestCase):
         self.assertEqual(cache.hit, calls)
         self.assertEqual(cache.miss, calls + 1)
         self.assertEqual(self.calls, calls + 1)
+
+    def test_delay_cache_ttl(self):
+        @udon.cache.delay_cache(10, ttl = lambda key, value: key[0])
+        def cache(delay):
+            return delay
+
+        cache(.05)
+        cache(0)
+        cache(10)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.skip, 1)
+        time.sleep(.05)
+        self.assertEqual(len(cache), 1)
+        cache(10)
+        self.assertEqual(cache.hit, 1)
+
+    def test_delay_cache_size(self):
+        self.calls = 0
+        cache = udon.cache.DelayCache(self.cached_function, delay = 10, size = 10)
+        for i in range(20):
+            cache(i)
+        self.assertEqual(len(cache), 10)
+        for i in range(10, 20):
+            cache(i)
+        self.assertEqual(cache.hit, 10)
+        self.assertEqual(self.calls, 20)
+
+    def test_delay_cache_replaced(self):
+        cache = udon.cache.DelayCache(None, delay = 10, ttl = lambda key, value: value)
+        cache.do_insert("a", .02)
+        cache.do_insert("b", 10)
+        cache.do_insert("a", 20)
+        time.sleep(.03)
+        # the stale heap entry of "a" must not evict "b"
+        self.assertEqual(len(cache), 2)
+
+    def test_delay_cache_stale(self):
+        self.calls = 0
+        cache = udon.cache.DelayCache(self.cached_function, delay = .05, stale = 10)
+        self.assertEqual(cache("foo"), 1)
+        time.sleep(.06)
+        # the stale value is returned while refreshing
+        self.assertEqual(cache("foo"), 1)
+        time.sleep(.02)
+        self.assertEqual(cache("foo"), 2)
+        self.assertEqual(cache.refreshes, 1)
+        self.assertEqual(cache.miss, 1)
+
+    def test_delay_cache_background_lock(self):
+        # refreshed values are inserted by other threads.
+        cache = udon.cache.DelayCache(self.cached_function, delay = 1, stale = 1)
+        self.assertIsInstance(cache.lock, type(threading.Lock()))
+        cache = udon.cache.DelayCache(self.cached_function, delay = 1, refresh = .5)
+        self.assertIsInstance(cache.lock, type(threading.Lock()))
+        cache = udon.cache.DelayCache(self.cached_function, delay = 1)
+        self.assertIsInstance(cache.lock, udon.util.nullcontext)
+        lock = threading.RLock()
+        cache = udon.cache.DelayCache(self.cached_function, delay = 1, stale = 1, lock = lock)
+        self.assertIs(cache.lock, lock)
+
+    def test_delay_cache_refresh(self):
+        self.calls = 0
+        def slow(key):
+            time.sleep(.02)
+            return self.cached_function(key)
+        cache = udon.cache.DelayCache(slow, delay = 10, refresh = 9.9,
+                                      max_refresh = 1, lock = threading.Lock())
+        for key in range(3):
+            cache(key)
+        time.sleep(.11)
+        for key in range(3):
+            cache(key)
+        time.sleep(.05)
+        # only one refresh at a time
+        self.assertEqual(cache.refreshes, 1)
+        self.assertEqual(self.calls, 4)
+        self.assertEqual(len(cache), 3)
+
+    def test_single_flight(self):
+        calls = []
+        def slow(key):
+            calls.append(key)
+            time.sleep(.1)
+            return key * 2
+
+        cache = udon.cache.LRUCache(slow, size = 10, lock = threading.Lock())
+        results = []
+        threads = [ threading.Thread(target = lambda i = i: results.append(cache(i % 2)))
+                    for i in range(8) ]
+        t0 = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # different keys are computed in parallel, the same key once.
+        self.assertLess(time.time() - t0, .19)
+        self.assertEqual(sorted(calls), [ 0, 1 ])
+        self.assertEqual(sorted(results), [ 0, 0, 0, 0, 2, 2, 2, 2 ])
+        self.assertEqual(cache.miss, 2)
+        self.assertEqual(cache.hit, 6)
+
+    def test_single_flight_error(self):
+        def fail(key):
+            time.sleep(.1)
+            raise ValueError(key)
+
+        cache = udon.cache.LRUCache(fail, size = 10, lock = threading.Lock())
+        errors = []
+        def _():
+            try:
+                cache("foo")
+            except ValueError as exc:
+                errors.append(exc)
+        threads = [ threading.Thread(target = _) for i in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 4)
+        self.assertEqual(len(cache), 0)
+
+    def test_single_flight_insert_error(self):
+        def weigher(key, value):
+            raise ValueError(key)
+        cache = udon.cache.WeightedLRUCache(lambda key: key, weigher, 100, lock = threading.Lock())
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                cache("foo")
+        self.assertEqual(cache.flights, {})
+
+    def test_single_flight_no_lock(self):
+        calls = []
+        def slow(key):
+            calls.append(key)
+            time.sleep(.05)
+            return key
+        cache = udon.cache.LRUCache(slow, size = 10)
+        threads = [ threading.Thread(target = cache, args = ("foo", )) for i in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [ "foo" ])
+
+    def test_no_cache(self):
+        def _(key):
+            raise udon.cache.NoCache(key)
+        cache = udon.cache.LRUCache(_, size = 10)
+        self.assertEqual(cache("foo"), "foo")
+        self.assertEqual(cache("foo"), "foo")
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.miss, 2)
+        self.assertEqual(cache.skip, 2)
+
+    def test_sharded_lru_cache(self):
+        self.calls = 0
+        cache = udon.cache.lru_cache(64, lock = True, shards = 4)(self.cached_function)
+        self.assertIsInstance(cache, udon.cache.ShardedLRUCache)
+        for i in range(32):
+            cache(i)
+        for i in range(32):
+            cache(i)
+        self.assertEqual(len(cache), 32)
+        self.assertEqual(cache.hit, 32)
+        self.assertEqual(cache.miss, 32)
+        self.assertEqual(cache.skip, 0)
+        self.assertEqual(self.calls, 32)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_sharded_lru_cache_lock(self):
+        # a lock instance gives the type of the per-shard locks.
+        lock = threading.Lock()
+        cache = udon.cache.lru_cache(100, lock = lock, shards = 4)(self.cached_function)
+        self.assertEqual(len({ id(shard.lock) for shard in cache.shards }), 4)
+        self.assertNotIn(lock, [ shard.lock for shard in cache.shards ])
+        self.assertIsInstance(cache.shards[0].lock, type(lock))
+        cache = udon.cache.lru_cache(100, lock = threading.RLock(), shards = 4)(self.cached_function)
+        self.assertIsInstance(cache.shards[0].lock, type(threading.RLock()))
+        cache = udon.cache.lru_cache(100, lock = threading.RLock, shards = 4)(self.cached_function)
+        self.assertIsInstance(cache.shards[0].lock, type(threading.RLock()))
+
+
+    def test_weighted_lru_cache(self):
+        @udon.cache.weighted_lru_cache(100, lambda key, value: len(value))
+        def cache(size):
+            return b"x" * size
+
+        for size in (10, 20, 30, 40):
+            cache(size)
+        self.assertEqual(len(cache), 4)
+        self.assertEqual(cache.weight, 100)
+
+        cache(10)
+        cache(50)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.weight, 100)
+        cache(20)
+        self.assertEqual(cache.miss, 6)
+        self.assertEqual(cache.weight, 80)
+
+        # oversized values are not cached.
+        self.assertEqual(len(cache(200)), 200)
+        self.assertEqual(cache.skip, 1)
+        self.assertEqual(cache.weight, 80)
+
+        cache.clear()
+        self.assertEqual(cache.weight, 0)
+
+
+    def scan_resistance(self, factory):
+        cache = factory(lambda key: key, 100)
+        hot = list(range(50))
+        for _ in range(5):
+            for key in hot:
+                cache(key)
+        for key in range(1000, 2000):
+            cache(key)
+        hit = cache.hit
+        for key in hot:
+            self.assertEqual(cache(key), key)
+        self.assertLessEqual(len(cache), 100)
+        return cache.hit - hit
+
+    def test_scan_resistance(self):
+        self.assertEqual(self.scan_resistance(udon.cache.LRUCache), 0)
+        self.assertGreaterEqual(self.scan_resistance(udon.cache.ARCCache), 45)
+        self.assertGreaterEqual(self.scan_resistance(udon.cache.TinyLFUCache), 45)
+
+    def test_tinylfu_cache(self):
+        self.calls = 0
+        cache = udon.cache.tinylfu_cache(10)(self.cached_function)
+        for i in range(100):
+            cache(i % 5)
+        self.assertEqual(self.calls, 5)
+        self.assertEqual(cache.hit, 95)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_arc_cache(self):
+        self.calls = 0
+        cache = udon.cache.arc_cache(10)(self.cached_function)
+        for i in range(100):
+            cache(i % 20)
+        self.assertEqual(len(cache), 10)
+        self.assertEqual(cache.miss, self.calls)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_arc_cache_ghost_tie(self):
+        cache = udon.cache.ARCCache(lambda key: key, 3)
+        for key in (0, 4, 1, 0, 2, 4, 1):
+            cache(key)
+        self.assertEqual((cache.p, list(cache.t1), list(cache.b2)), (2, [ (2, ) ], [ (0, ) ]))
+        # a b2 hit lowers p to len(t1): the replacement is taken from t1.
+        cache(0)
+        self.assertEqual(cache.p, 1)
+        self.assertEqual(list(cache.t1), [])
+        self.assertEqual(list(cache.b1), [ (2, ) ])
+        self.assertEqual(list(cache.t2), [ (4, ), (1, ), (0, ) ])
+
+    def test_clock_cache(self):
+        self.calls = 0
+        cache = udon.cache.clock_cache(3)(self.cached_function)
+        for i in (1, 2, 3, 1):
+            cache(i)
+        self.assertEqual((cache.hit, cache.miss), (1, 3))
+
+        # 1 gets a second chance, 2 is evicted
+        cache(4)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(set(cache.index), { (1, ), (3, ), (4, ) })
+        cache(1)
+        self.assertEqual(self.calls, 4)
+        cache(2)
+        self.assertEqual(self.calls, 5)
+        self.assertEqual(len(cache), 3)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        cache(1)
+        self.assertEqual(self.calls, 6)
+
+    def test_clock_cache_threads(self):
+        cache = udon.cache.ClockCache(lambda key: key * 2, 50, lock = threading.Lock())
+        errors = []
+        def worker(seed):
+            for i in range(2000):
+                key = (i * seed) % 80
+                if cache(key) != key * 2:
+                    errors.append(key)
+        threads = [ threading.Thread(target = worker, args = (i, )) for i in range(1, 5) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(cache), 50)
+
+
+    def test_shared_memory_cache(self):
+        self.calls = 0
+        cache = udon.cache.SharedMemoryCache(self.cached_function, 64, slots = 64)
+        for i in range(10):
+            cache(i)
+        for i in range(10):
+            cache(i)
+        self.assertEqual(len(cache), 10)
+        self.assertEqual(cache.hit, 10)
+        self.assertEqual(self.calls, 10)
+
+        # too large to be cached
+        cache("x" * 100)
+        self.assertEqual(cache.skip, 1)
+
+        for i in range(200):
+            cache(i)
+        self.assertLessEqual(len(cache), 64)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_shared_memory_cache_fork(self):
+        cache = udon.cache.SharedMemoryCache(lambda key: (key, os.getpid()), 256, slots = 64)
+        context = multiprocessing.get_context("fork")
+        process = context.Process(target = lambda: cache("foo"))
+        process.start()
+        process.join()
+        self.assertEqual(cache("foo"), ("foo", process.pid))
+        self.assertEqual(cache.hit, 1)
+        self.assertEqual(cache.miss, 0)
+
+
+    def test_tiered_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = udon.store.KeyStore(tmpdir)
+            self.calls = 0
+            cache = udon.cache.TieredCache(self.cached_function, 5, store, 10)
+            for i in range(20):
+                cache(i)
+            self.assertEqual(len(cache), 5)
+            self.assertEqual(len(cache.index), 10)
+
+            # restart with a cold memory tier.
+            cache = udon.cache.TieredCache(self.cached_function, 5, store, 10)
+            self.assertEqual(cache(15), 16)
+            self.assertEqual(cache.store_hit, 1)
+            self.assertEqual(cache(15), 16)
+            self.assertEqual(cache.store_hit, 1)
+            # disk hits are memory misses.
+            self.assertEqual(cache.hit, 1)
+            self.assertEqual(cache.miss, 1)
+            self.assertEqual(cache(5), 21)
+            self.assertEqual(self.calls, 21)
+
+            cache.clear()
+            self.assertEqual(list(store.walk()), [])
+
+    def test_tiered_cache_delay(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = udon.store.KeyStore(tmpdir)
+            self.calls = 0
+            cache = udon.cache.TieredCache(self.cached_function, 5, store, 10, delay = .05)
+            cache("foo")
+            cache = udon.cache.TieredCache(self.cached_function, 5, store, 10, delay = .05)
+            time.sleep(.05)
+            self.assertEqual(cache("foo"), 2)
+
+            # values expire from memory too.
+            time.sleep(.05)
+            self.assertEqual(cache("foo"), 3)
+            self.assertEqual(cache.store_hit, 0)
+
+    def test_tiered_cache_store_error(self):
+        class Store(udon.store.KeyStore):
+            def path(self, key):
+                return os.path.join(self.root, "missing", key[:2], key)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = Store(tmpdir)
+            # a file in the way of the content directories
+            with open(os.path.join(tmpdir, "missing"), "w"):
+                pass
+            cache = udon.cache.TieredCache(lambda key: key * 2, 5, store, 10)
+            with self.assertLogs("udon.cache", "ERROR"):
+                self.assertEqual(cache(3), 6)
+            self.assertEqual(cache(3), 6)
+            self.assertEqual(cache.hit, 1)
+            self.assertEqual(len(cache.index), 0)
+
+    def test_tiered_cache_unlocked_io(self):
+        class Store(udon.store.KeyStore):
+            def path(self, key):
+                assert not cache.lock.locked()
+                return super().path(key)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = Store(tmpdir)
+            self.calls = 0
+            cache = udon.cache.TieredCache(self.cached_function, 1, store, 2, lock = threading.Lock())
+            for i in range(4):
+                cache(i)
+            self.assertEqual(cache(2), 3)
+            self.assertEqual(cache.store_hit, 1)
+            self.assertEqual(len(list(store.walk())), 2)
+
+
+    def test_batch_cache(self):
+        batches = []
+        @udon.cache.batch_cache(100, max_batch = 3)
+        def cache(keys):
+            batches.append(sorted(keys))
+            return { key: key * 2 for key in keys if key != 4 }
+
+        self.assertEqual(cache.get_many([ 1, 2 ]), { 1: 2, 2: 4 })
+        self.assertEqual(cache.get_many([ 1, 2, 3, 4 ]), { 1: 2, 2: 4, 3: 6 })
+        self.assertEqual(cache(3), 6)
+        with self.assertRaises(KeyError):
+            cache(4)
+        self.assertEqual(cache.get_many(range(5, 12)), { key: key * 2 for key in range(5, 12) })
+        self.assertEqual(batches, [ [ 1, 2 ], [ 3, 4 ], [ 4 ], [ 5, 6, 7 ], [ 8, 9, 10 ], [ 11 ] ])
+        self.assertEqual(len(cache), 10)
+
+    def test_batch_cache_window(self):
+        batches = []
+        @udon.cache.batch_cache(100, window = .05)
+        def cache(keys):
+            batches.append(sorted(keys))
+            return { key: key * 2 for key in keys }
+
+        results = []
+        threads = [ threading.Thread(target = lambda i = i: results.append(cache.get_many([ i, i + 1 ])))
+                    for i in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(batches, [ [ 0, 1, 2, 3, 4 ] ])
+        self.assertEqual(sorted(results, key = min),
+                         [ { i: i * 2, i + 1: (i + 1) * 2 } for i in range(4) ])
+
+
+    def test_metrics(self):
+        def slow(key):
+            time.sleep(.01)
+            return key
+        cache = udon.cache.LRUCache(slow, size = 5, lock = threading.Lock())
+        cache.set_metrics(udon.cache.CacheMetrics())
+        for i in range(10):
+            cache(i)
+        cache(9)
+
+        stats = cache.stats()
+        self.assertEqual(stats['name'], slow.__qualname__)
+        self.assertEqual(stats['type'], 'LRUCache')
+        self.assertEqual((stats['size'], stats['hit'], stats['miss']), (5, 1, 10))
+        self.assertEqual(stats['evictions'], 5)
+        self.assertEqual(stats['compute']['count'], 10)
+        self.assertGreaterEqual(stats['compute']['sum'], .1)
+        self.assertEqual(sum(count for _, count in stats['compute']['buckets']), 10)
+        self.assertGreater(stats['lock_wait']['count'], 0)
+
+        cache.set_metrics(None)
+        self.assertIsInstance(cache.lock, type(threading.Lock()))
+
+    def test_metrics_expire(self):
+        cache = udon.cache.DelayCache(self.cached_function, delay = .01)
+        cache.set_metrics(udon.cache.CacheMetrics())
+        cache(1)
+        cache(2)
+        time.sleep(.01)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.metrics.expirations, 2)
+
+    def test_registry(self):
+        cache = udon.cache.LRUCache(self.cached_function, size = 5)
+        sharded = udon.cache.ShardedLRUCache(self.cached_function, size = 5, shards = 2)
+        caches = udon.cache.caches()
+        self.assertIn(cache, caches)
+        self.assertIn(sharded, caches)
+        self.assertNotIn(sharded.shards[0], caches)
+        self.assertIn(cache.stats(), udon.cache.stats())
+        count = len(caches)
+        del cache, caches
+        gc.collect()
+        self.assertEqual(len(udon.cache.caches()), count - 1)
+
+
+    def test_snapshot(self):
+        self.calls = 0
+        cache = udon.cache.LRUCache(self.cached_function, size = 5)
+        for i in range(6):
+            cache(i)
+        cache(2)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "snapshot")
+            self.assertEqual(cache.snapshot(path), 5)
+
+            # keys only: recomputed in the background, hottest first
+            other = udon.cache.LRUCache(lambda key: -key, size = 5)
+            futures = other.preload(path, workers = 1)
+            self.assertEqual([ future.result() for future in futures ], [ -2, -5, -4, -3, -1 ])
+            self.assertEqual([ key for key, _ in other.do_items() ], [ (1, ), (3, ), (4, ), (5, ), (2, ) ])
+
+            # values: inserted as is, in the same order
+            cache.snapshot(path, values = True)
+            other = udon.cache.LRUCache(lambda key: -key, size = 5)
+            self.assertEqual(other.preload(path), [])
+            self.assertEqual(list(other.do_items()), list(cache.do_items()))
+            self.assertEqual(other.miss, 0)
+
+            sharded = udon.cache.ShardedLRUCache(lambda key: -key, size = 5, shards = 2)
+            sharded.preload(path)
+            self.assertEqual(sorted(sharded.do_items()), sorted(cache.do_items()))
+
+    def test_snapshot_delay(self):
+        cache = udon.cache.DelayCache(lambda key: -key, delay = 10)
+        for i in range(3):
+            cache(i)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "snapshot")
+            cache.snapshot(path, values = True)
+            other = udon.cache.DelayCache(self.cached_function, delay = 10)
+            other.preload(path)
+            self.assertEqual(list(other.do_items()), [ ((2, ), -2), ((1, ), -1), ((0, ), 0) ])
+
+            # the remaining delay is kept, and expired values are dropped
+            self.assertLessEqual(other.mapping[(2, )][0], cache.mapping[(2, )][0])
+            cache = udon.cache.DelayCache(lambda key: -key, delay = 0.05)
+            cache(3)
+            cache.snapshot(path, values = True)
+            time.sleep(0.1)
+            other = udon.cache.DelayCache(self.cached_function, delay = 10)
+            other.preload(path)
+            self.assertEqual(list(other.do_items()), [])
+
+    def test_snapshot_shared_memory(self):
+        cache = udon.cache.SharedMemoryCache(lambda key: -key, 64, slots = 64)
+        for i in range(3):
+            cache(i)
+        cache(0)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "snapshot")
+            self.assertEqual(cache.snapshot(path, values = True), 3)
+            other = udon.cache.SharedMemoryCache(self.cached_function, 64, slots = 64)
+            self.assertEqual(other.preload(path), [])
+            self.assertEqual(list(other.do_items()), [ ((0, ), 0), ((2, ), -2), ((1, ), -1) ])
+
+    def test_snapshot_batch(self):
+        calls = []
+        def load(keys):
+            calls.append(list(keys))
+            return { key: -key for key in keys }
+        cache = udon.cache.BatchCache(load, 10)
+        cache.get_many([ 1, 2, 3 ])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "snapshot")
+            self.assertEqual(cache.snapshot(path), 3)
+            other = udon.cache.BatchCache(load, 10)
+            futures = other.preload(path)
+            self.assertEqual([ future.result() for future in futures ], [ { 1: -1, 2: -2, 3: -3 } ])
+            self.assertEqual(calls[-1], [ 3, 2, 1 ])
+            self.assertEqual(other(2), -2)
+
+
+    def test_batch_insert_error(self):
+        class Cache(udon.cache.BatchCache):
+            def do_insert(self, key, value):
+                if key == 2:
+                    raise ValueError(key)
+                super().do_insert(key, value)
+        cache = Cache(lambda keys: { key: key for key in keys }, 10)
+        with self.assertRaises(ValueError):
+            cache.get_many([ 1, 2, 3 ])
+        self.assertEqual(cache.flights, {})
+        self.assertEqual(cache(3), 3)
+
+
+class TestAsyncCache(unittest.TestCase):
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_need_coroutine(self):
+        with self.assertRaises(TypeError):
+            udon.cache.async_lru_cache(10)(lambda key: key)
+
+    def test_lru_cache(self):
+        calls = []
+
+        @udon.cache.async_lru_cache(10)
+        async def cached(key):
+            calls.append(key)
+            await asyncio.sleep(.05)
+            return key * 2
+
+        async def _():
+            results = await asyncio.gather(*[ cached(i % 3) for i in range(9) ])
+            results.append(await cached(1))
+            return results
+
+        self.assertEqual(self.run_async(_()), [ 0, 2, 4 ] * 3 + [ 2 ])
+        self.assertEqual(sorted(calls), [ 0, 1, 2 ])
+        self.assertEqual(cached.miss, 3)
+        self.assertEqual(cached.hit, 7)
+
+    def test_shared_between_loops(self):
+        calls = []
+
+        @udon.cache.async_lru_cache(10)
+        async def cached(key):
+            calls.append(key)
+            await asyncio.sleep(.05)
+            return key * 2
+
+        results = []
+        def run():
+            results.append(self.run_async(cached(3)))
+        threads = [ threading.Thread(target = run) for _ in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, [ 6 ] * 4)
+        self.assertEqual(calls, [ 3 ])
+        self.assertEqual(cached.hit, 3)
+
+    def test_delay_cache_errors(self):
+        calls = []
+
+        @udon.cache.async_delay_cache(10)
+        async def cached(key):
+            calls.append(key)
+            await asyncio.sleep(.01)
+            if key == "error":
+                raise ValueError(key)
+            raise udon.cache.NoCache(key)
+
+        async def _():
+            results = await asyncio.gather(cached("error"), cached("error"),
+                                           return_exceptions = True)
+            self.assertTrue(all(isinstance(res, ValueError) for res in results))
+            self.assertEqual(await cached("foo"), "foo")
+            self.assertEqual(await cached("foo"), "foo")
+
+        self.run_async(_())
+        self.assertEqual(calls, [ "error", "foo", "foo" ])
+        self.assertEqual(len(cached), 0)
+        self.assertEqual(cached.skip, 2)
+
+    def test_delay_cache_refresh(self):
+        calls = []
+
+        @udon.cache.async_delay_cache(10, refresh = 10)
+        async def cached(key):
+            calls.append(key)
+            await asyncio.sleep(.02)
+            return len(calls)
+
+        async def _():
+            self.assertEqual(await cached("foo"), 1)
+            self.assertEqual(await cached("foo"), 1)
+            self.assertEqual(len(cached.tasks), 1)
+            await asyncio.sleep(.05)
+            self.assertEqual(cached.tasks, set())
+            self.assertEqual(list(cached.do_items()), [ (("foo", ), 2) ])
+
+        self.run_async(_())
+        self.assertEqual(cached.refreshes, 1)
+
+    def test_snapshot(self):
+        @udon.cache.async_lru_cache(10)
+        async def cached(key):
+            await asyncio.sleep(.01)
+            return key * 2
+
+        async def _():
+            for i in range(3):
+                await cached(i)
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, "snapshot")
+                cached.snapshot(path)
+                cached.clear()
+                futures = cached.preload(path, workers = 2)
+                return await asyncio.gather(*futures)
+
+        self.assertEqual(self.run_async(_()), [ 4, 2, 0 ])
+        self.assertEqual(len(cached), 3)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "snapshot")
+            cached.snapshot(path)
+            with self.assertRaises(RuntimeError):
+                cached.preload(path)
+
+    def test_threadlet(self):
+        @udon.cache.async_lru_cache(10)
+        async def cached(key):
+            await asyncio.sleep(.01)
+            return key + 1
+
+        seen = []
+        async def tick(task):
+            seen.append(await cached(len(seen) % 2))
+            if len(seen) == 4:
+                task.thread.stop()
+
+        async def _():
+            thread = udon.asynchronous.Threadlet()
+            thread.set_tasklet(tick, period = .01)
+            thread.start()
+            await thread
+
+        self.run_async(_())
+        self.assertEqual(seen, [ 1, 2, 1, 2 ])
+        self.assertEqual(cached.miss, 2)
@@ -1,6 +1,8 @@
+import asyncio
 import os
 import tempfile
 import unittest
+import gzip
 import hashlib
 
 import udon.content
@@ -130,3 +132,72 @@ class TestContent(unittest.TestCase):
         with self.assertRaises(AssertionError):
             with udon.content.reader(path):
                 pass
+
+    def test_variants(self):
+        path = self.content_path()
+        datain = b"some text content\n" * 100
+
+        with udon.content.writer(path, encodings = ("gzip",)) as fp:
+            fp.write_header("Content-Type", "text/plain")
+            fp.write(datain)
+
+        with udon.content.reader(path) as fp:
+            self.assertEqual(udon.content.variants(fp), ["gzip"])
+            with udon.content.variant_reader(fp, "gzip") as vfp:
+                headers = dict(vfp.info.headers)
+                self.assertEqual(headers["Content-Encoding"], "gzip")
+                self.assertEqual(headers["Content-Type"], "text/plain")
+                self.assertEqual(gzip.decompress(vfp.read()), datain)
+            self.assertEqual(fp.read(), datain)
+
+    def test_variants_dropped(self):
+        path = self.content_path()
+        with udon.content.writer(path, encodings = ("gzip",)) as fp:
+            fp.write(os.urandom(1024))
+
+        with udon.content.reader(path) as fp:
+            self.assertEqual(udon.content.variants(fp), [])
+            with self.assertRaises(KeyError):
+                udon.content.variant_reader(fp, "gzip")
+        self.assertFalse(os.path.exists(udon.content.variant_path(path, "gzip")))
+
+    def test_variants_content_encoding(self):
+        path = self.content_path()
+        with udon.content.writer(path) as fp:
+            fp.write_header("Content-Encoding", "gzip")
+            fp.write(gzip.compress(b"foo"))
+        with udon.content.reader(path) as fp:
+            self.assertEqual(dict(fp.info.headers)["Content-Encoding"], "gzip")
+
+        with self.assertRaises(ValueError):
+            with udon.content.writer(self.content_path(), encodings = ("gzip",)) as fp:
+                fp.write_header("Content-Encoding", "gzip")
+
+    def test_variants_unsupported(self):
+        with self.assertRaises(ValueError):
+            with udon.content.writer(self.content_path(), encodings = ("foo",)):
+                pass
+
+    def test_async(self):
+        path = self.content_path()
+        datain = b"some content\n" * 10000
+
+        async def _():
+            async with udon.content.awriter(path) as fp:
+                await fp.write_header("Foo", "Bar")
+                await fp.write(datain[:10])
+                await fp.write(datain[10:])
+            async with await udon.content.areader(path) as fp:
+                self.assertIn(("Foo", "Bar"), fp.info.headers)
+                return fp.info, b"".join([ chunk async for chunk in fp ])
+
+        loop = asyncio.new_event_loop()
+        try:
+            info, dataout = loop.run_until_complete(_())
+        finally:
+            loop.close()
+        self.assertEqual(dataout, datain)
+        self.assertEqual(info.sha256, hashlib.sha256(datain).hexdigest())
+
+        with udon.content.reader(path) as fp:
+            self.assertEqual(fp.read(), datain)
@@ -1,6 +1,13 @@
+import asyncio
+import io
+import queue
+import random
+import threading
+import time
 import unittest
 
 import udon.datastructure
+import udon.io
 
 
 class TestDoublyLinkedList(unittest.TestCase):
@@ -97,7 +104,7 @@ class TestDoublyLinkedList(unittest.TestCase):
         self.assertEqual(len(lst), 0)
 
     def test_insert(self):
-        lst = udon.datastructure.DoublyLinkedList()
+        lst = self.make_list()
         node = { c: lst.insert_tail(c) for c in "bcegh" }
         lst.insert_before("a", node['b'])
         lst.insert_after("i", node['h'])
@@ -106,6 +113,26 @@ class TestDoublyLinkedList(unittest.TestCase):
         self.assertEqual("".join(lst), "abcdefghi")
 
 
+class TestCompactDoublyLinkedList(TestDoublyLinkedList):
+
+    def make_list(self, entries = ()):
+        return udon.datastructure.CompactDoublyLinkedList(entries)
+
+    def test_remove(self):
+        lst = self.make_list()
+        node = { c: lst.insert_tail(c) for c in "abcde" }
+        lst.remove(node['b'])
+        lst.remove(node['e'])
+        self.assertEqual("".join(lst), "acd")
+        self.assertEqual("".join(reversed(lst)), "dca")
+        # handles are reused
+        self.assertIn(lst.insert_head("f"), (node['b'], node['e']))
+        self.assertEqual(len(lst.items), 6)
+        self.assertEqual("".join(lst), "facd")
+        self.assertEqual(list(lst.pop_tail_n(5)), list("dcaf"))
+        self.assertFalse(lst)
+
+
 class TestPriorityQueue(unittest.TestCase):
 
     def make_queue(self, entries = ()):
@@ -173,3 +200,267 @@ class TestPriorityQueue(unittest.TestCase):
         result = [ entry for entry, prio in prioq.pop_until(100) ]
         self.assertEqual(result, elements)
         self.assertEqual(len(prioq), len(elements) - len(result))
+
+
+class TestIndexedPriorityQueue(TestPriorityQueue):
+
+    def make_queue(self, entries = ()):
+        prioq = udon.datastructure.IndexedPriorityQueue()
+        for priority, entry in enumerate(entries):
+            prioq.insert(entry, priority)
+        return prioq
+
+    def test_update(self):
+        prioq = self.make_queue("abcdefgh")
+        prioq.update("g", -1)
+        prioq.update("a", 4.5)
+        prioq.insert("b", 10)
+        self.assertEqual(prioq.priority("a"), 4.5)
+        self.assertEqual("".join(entry for entry, prio in prioq), "gcdeafhb")
+        with self.assertRaises(KeyError):
+            prioq.update("a", 0)
+
+    def test_remove(self):
+        prioq = self.make_queue("abcdefgh")
+        for entry in "hadf":
+            prioq.remove(entry)
+        self.assertNotIn("a", prioq)
+        self.assertIn("b", prioq)
+        with self.assertRaises(KeyError):
+            prioq.remove("a")
+        prioq.discard("a")
+        self.assertEqual("".join(entry for entry, prio in prioq), "bceg")
+
+    def test_ties(self):
+        prioq = udon.datastructure.IndexedPriorityQueue()
+        items = [ object() for _ in range(10) ]
+        for item in items:
+            prioq.insert(item, 0)
+        prioq.remove(items[3])
+        prioq.update(items[5], 0)
+        self.assertEqual([ entry for entry, prio in prioq ], items[:3] + items[4:])
+
+    def test_random(self):
+        rnd = random.Random(0)
+        prioq = udon.datastructure.IndexedPriorityQueue()
+        expected = {}
+        for _ in range(2000):
+            item = rnd.randrange(200)
+            if item in expected and rnd.random() < .3:
+                prioq.remove(item)
+                del expected[item]
+            else:
+                expected[item] = rnd.random()
+                prioq.insert(item, expected[item])
+        self.assertEqual([ prio for entry, prio in prioq ], sorted(expected.values()))
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def test_pop_until(self):
+        wheel = udon.datastructure.TimerWheel(resolution = .01)
+        for i, deadline in enumerate((.5, .05, 3, .05, 700, 100000)):
+            wheel.insert(i, deadline)
+        self.assertEqual(len(wheel), 6)
+        self.assertEqual(list(wheel.pop_until(.01)), [])
+        self.assertEqual(list(wheel.pop_until(1)), [ (1, .05), (3, .05), (0, .5) ])
+        self.assertEqual(list(wheel.pop_until(1)), [])
+        self.assertEqual(list(wheel.pop_until(699)), [ (2, 3) ])
+        self.assertEqual(list(wheel.pop_until(800)), [ (4, 700) ])
+        self.assertEqual(list(wheel.pop_until(99999.99)), [])
+        self.assertEqual(list(wheel.pop_until(100000)), [ (5, 100000) ])
+        self.assertFalse(wheel)
+
+    def test_cancel(self):
+        wheel = udon.datastructure.TimerWheel(resolution = 1)
+        for i in range(10):
+            wheel.insert(i, i * 100)
+        wheel.cancel(3)
+        wheel.discard(3)
+        wheel.insert(5, 10)
+        self.assertNotIn(3, wheel)
+        with self.assertRaises(KeyError):
+            wheel.cancel(3)
+        self.assertEqual([ item for item, _ in wheel.pop_until(1000) ], [ 0, 5, 1, 2, 4, 6, 7, 8, 9 ])
+
+    def test_past(self):
+        wheel = udon.datastructure.TimerWheel(resolution = 1)
+        list(wheel.pop_until(100))
+        wheel.insert("a", 50)
+        self.assertEqual(list(wheel.pop_until(100)), [ ("a", 50) ])
+
+    def test_random(self):
+        rnd = random.Random(0)
+        wheel = udon.datastructure.TimerWheel(resolution = .001)
+        expected = []
+        for i in range(5000):
+            deadline = rnd.expovariate(1 / 1000)
+            wheel.insert(i, deadline)
+            expected.append((deadline, i))
+        now = 0
+        result = []
+        while wheel:
+            now += rnd.expovariate(1 / 50)
+            for item, deadline in wheel.pop_until(now):
+                self.assertLessEqual(deadline, now)
+                result.append((deadline, item))
+        self.assertEqual(result, sorted(expected))
+
+
+class TestBlockingPriorityQueue(unittest.TestCase):
+
+    def test_threads(self):
+        prioq = udon.datastructure.BlockingPriorityQueue(maxsize = 2)
+        result = []
+        def consume():
+            for _ in range(10):
+                result.append(prioq.pop())
+        thread = threading.Thread(target = consume)
+        thread.start()
+        for i in range(10):
+            prioq.insert(i, i)
+        thread.join()
+        self.assertEqual(result, [ (i, i) for i in range(10) ])
+
+    def test_timeout(self):
+        prioq = udon.datastructure.BlockingPriorityQueue(maxsize = 1)
+        with self.assertRaises(queue.Empty):
+            prioq.pop(timeout = .01)
+        prioq.insert("a", 1)
+        with self.assertRaises(queue.Full):
+            prioq.insert("b", 0, timeout = .01)
+        self.assertEqual(list(prioq.pop_until(1)), [ ("a", 1) ])
+
+    def test_pop_due(self):
+        prioq = udon.datastructure.BlockingPriorityQueue()
+        now = time.time()
+        prioq.insert("b", now + .05)
+        threading.Timer(.01, prioq.insert, args = ("a", now + .02)).start()
+        self.assertEqual(prioq.pop_due(), ("a", now + .02))
+        self.assertGreaterEqual(time.time(), now + .02)
+        with self.assertRaises(queue.Empty):
+            prioq.pop_due(timeout = .01)
+        self.assertEqual(prioq.pop_due(), ("b", now + .05))
+        self.assertGreaterEqual(time.time(), now + .05)
+
+    def test_async(self):
+        prioq = udon.datastructure.BlockingPriorityQueue(maxsize = 1)
+
+        async def run():
+            # woken up by a thread
+            threading.Timer(.01, prioq.insert, args = ("a", 0)).start()
+            self.assertEqual(await prioq.apop(), ("a", 0))
+            with self.assertRaises(queue.Empty):
+                await prioq.apop(timeout = .01)
+
+            await prioq.ainsert("b", time.time() + .02)
+            with self.assertRaises(queue.Full):
+                await prioq.ainsert("c", 0, timeout = .01)
+            insert = asyncio.ensure_future(prioq.ainsert("c", 0))
+            item, _ = await prioq.apop_due()
+            self.assertEqual(item, "b")
+            await insert
+            self.assertEqual(await prioq.apop_due(), ("c", 0))
+            self.assertEqual(prioq.waiters, [])
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(run())
+        loop.close()
+
+
+class TestSortedMap(unittest.TestCase):
+
+    def test_map(self):
+        smap = udon.datastructure.SortedMap()
+        rnd = random.Random(0)
+        expected = {}
+        for _ in range(3000):
+            key = rnd.randrange(500)
+            if key in expected and rnd.random() < .4:
+                del smap[key]
+                del expected[key]
+            else:
+                smap[key] = expected[key] = rnd.random()
+        self.assertEqual(len(smap), len(expected))
+        self.assertEqual(list(smap.items()), sorted(expected.items()))
+        self.assertEqual(smap.get(-1), None)
+        with self.assertRaises(KeyError):
+            del smap[-1]
+        self.assertEqual(smap.pop(-1, "x"), "x")
+        self.assertEqual(smap.first(), min(expected.items()))
+        self.assertEqual(smap.last(), max(expected.items()))
+        smap.clear()
+        self.assertEqual(list(smap), [])
+        with self.assertRaises(KeyError):
+            smap.first()
+
+    def test_floor_ceiling(self):
+        smap = udon.datastructure.SortedMap({ 10: "a", 20: "b", 30: "c" })
+        self.assertEqual(smap.floor(20), (20, "b"))
+        self.assertEqual(smap.floor(25), (20, "b"))
+        self.assertEqual(smap.ceiling(25), (30, "c"))
+        self.assertEqual(smap.ceiling(5), (10, "a"))
+        with self.assertRaises(KeyError):
+            smap.floor(5)
+        with self.assertRaises(KeyError):
+            smap.ceiling(31)
+
+    def test_irange(self):
+        smap = udon.datastructure.SortedMap.from_sorted((i, str(i)) for i in range(0, 100, 2))
+        self.assertEqual(len(smap), 50)
+        self.assertEqual([ key for key, _ in smap.irange(11, 20) ], [ 12, 14, 16, 18 ])
+        self.assertEqual([ key for key, _ in smap.irange(stop = 5) ], [ 0, 2, 4 ])
+        self.assertEqual([ key for key, _ in smap.irange(95) ], [ 96, 98 ])
+        smap[51] = "51"
+        del smap[50]
+        self.assertEqual(list(smap.irange(48, 54)), [ (48, "48"), (51, "51"), (52, "52") ])
+
+        with self.assertRaises(ValueError):
+            udon.datastructure.SortedMap.from_sorted([ (1, 1), (3, 3), (2, 2) ])
+        with self.assertRaises(ValueError):
+            udon.datastructure.SortedMap.from_sorted([ (1, 1), (1, 1) ])
+
+
+class TestRingBuffer(unittest.TestCase):
+
+    def test_wrap_around(self):
+        ring = udon.datastructure.RingBuffer(8)
+        self.assertEqual(ring.write(b"abcdef"), 6)
+        self.assertEqual(ring.read(4), b"abcd")
+        self.assertEqual(ring.write(b"ghijklmn"), 6)
+        self.assertEqual(ring.free(), 0)
+        self.assertEqual([ bytes(view) for view in ring.read_views() ], [ b"efgh", b"ijkl" ])
+        ring.consume(5)
+        self.assertEqual(ring.read(), b"jkl")
+        self.assertFalse(ring)
+        self.assertEqual(len(ring.write_views()[0]), 8)
+        with self.assertRaises(ValueError):
+            ring.consume(1)
+
+    def test_write_views(self):
+        ring = udon.datastructure.RingBuffer(8)
+        ring.write(b"abcdef")
+        ring.consume(3)
+        views = ring.write_views()
+        self.assertEqual([ len(view) for view in views ], [ 2, 3 ])
+        views[0][:] = b"gh"
+        views[1][:1] = b"i"
+        ring.commit(3)
+        with self.assertRaises(ValueError):
+            ring.commit(3)
+        self.assertEqual(ring.read(), b"defghi")
+
+    def test_readinto(self):
+        ring = udon.datastructure.RingBuffer(4)
+        source = io.BytesIO(b"0123456789")
+        self.assertEqual(ring.readinto(source), 4)
+        with self.assertRaises(BufferError):
+            ring.readinto(source)
+        ring.consume(3)
+        self.assertEqual(ring.readinto(source), 3)
+        self.assertEqual(ring.read(), b"3456")
+
+        data = b"".join(bytes(view) for view in udon.io.views(source, chunk_size = 2, expect_size = 3))
+        self.assertEqual(data, b"789")
+        with self.assertRaises(ValueError):
+            list(udon.io.views(io.BytesIO(b"x"), expect_size = 2))
@@ -0,0 +1,118 @@
+import os
+import tempfile
+import unittest
+
+import udon.content
+import udon.segment
+import udon.store
+
+
+class TestSegment(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, *parts):
+        return os.path.join(self.tmpdir.name, *parts)
+
+    def make_store(self, name, count):
+        store = udon.store.KeyStore(self.path(name))
+        for i in range(count):
+            key = "key-%03d" % i
+            with udon.content.writer(self.path("content")) as fp:
+                fp.write(b"data %d\n" % i * i)
+            with open(self.path("content"), "rb") as fp:
+                store.put(key, fp.read())
+        return store
+
+    def test_read(self):
+        path = self.path("segment")
+        with udon.segment.writer(path) as wrt:
+            wrt.add("foo", b"foo data")
+            wrt.add("bar", b"")
+            wrt.add("baz", b"baz data")
+
+        with udon.segment.reader(path) as rdr:
+            self.assertEqual(len(rdr), 3)
+            self.assertEqual(list(rdr.keys()), ["foo", "bar", "baz"])
+            self.assertEqual(rdr.read("baz"), b"baz data")
+            self.assertEqual(rdr.read("bar"), b"")
+            with rdr.open("foo") as fp:
+                self.assertEqual(fp.read(3), b"foo")
+                self.assertEqual(fp.read(), b" data")
+            self.assertEqual(list(rdr), [ ("foo", b"foo data"),
+                                          ("bar", b""),
+                                          ("baz", b"baz data") ])
+            with self.assertRaises(KeyError):
+                rdr.read("qux")
+
+    def test_invalid(self):
+        path = self.path("segment")
+        with open(path, "wb") as fp:
+            fp.write(b"not a segment file")
+        with self.assertRaises(ValueError):
+            udon.segment.reader(path)
+
+    def test_pack_unpack(self):
+        source = self.make_store("source", 20)
+        paths = udon.segment.pack(source, self.path("export"), segment_size = 1024)
+        self.assertGreater(len(paths), 1)
+
+        target = udon.store.KeyStore(self.path("target"))
+        self.assertEqual(udon.segment.unpack(paths, target, max_pending = 4), 20)
+        for i in range(20):
+            key = "key-%03d" % i
+            with source.open(key) as sfp, target.open(key) as tfp:
+                self.assertEqual(sfp.read(), tfp.read())
+
+    def test_unpack_sha256(self):
+        path = self.path("segment")
+        with udon.content.writer(self.path("content")) as fp:
+            fp.write(b"some data")
+        with open(self.path("content"), "rb") as fp:
+            data = fp.read()
+        source = udon.store.SHA256Store(self.path("source"))
+        key = source.put(data)
+        with udon.segment.writer(path) as wrt:
+            wrt.add(key, data)
+
+        target = udon.store.SHA256Store(self.path("target"))
+        self.assertEqual(udon.segment.unpack([ path ], target), 1)
+        self.assertEqual(list(target.walk()), [ key ])
+        with target.open(key) as fp:
+            self.assertEqual(fp.read(), data)
+
+        # keys that the store would not accept
+        with udon.segment.writer(path) as wrt:
+            wrt.add("foo", data)
+        with self.assertRaises(ValueError):
+            udon.segment.unpack([ path ], target)
+
+        # valid keys that do not match the record
+        with udon.segment.writer(path) as wrt:
+            wrt.add("0" * 64, data)
+        with self.assertRaises(ValueError):
+            udon.segment.unpack([ path ], target)
+        self.assertFalse(target.has("0" * 64))
+
+        # other stores take any recorded key
+        target = udon.store.KeyStore(self.path("keys"))
+        self.assertEqual(udon.segment.unpack([ path ], target), 1)
+        self.assertTrue(target.has("0" * 64))
+
+    def test_unpack_corrupted(self):
+        path = self.path("segment")
+        with udon.content.writer(self.path("content")) as fp:
+            fp.write(b"some data")
+        with open(self.path("content"), "rb") as fp:
+            data = fp.read()
+        with udon.segment.writer(path) as wrt:
+            wrt.add("foo", data[:-1] + b"!")
+
+        target = udon.store.KeyStore(self.path("target"))
+        with self.assertRaises(ValueError):
+            udon.segment.unpack([ path ], target)
+        self.assertFalse(target.has("foo"))
@@ -64,3 +64,14 @@ class TestContent(unittest.TestCase):
         store.put(key, value2)
         with store.open(key) as stream:
             self.assertEqual(stream.read(), value2)
+
+    def test_insert(self):
+        store = self.store()
+        self.assertTrue(store.insert("test_insert", b"foo"))
+        self.assertFalse(store.insert("test_insert", b"bar"))
+        with store.open("test_insert") as stream:
+            self.assertEqual(stream.read(), b"bar")
+
+        store = udon.store.SHA256Store(self.tmpdir.name)
+        with self.assertRaises(ValueError):
+            store.insert("foo", b"foo")
@@ -1,9 +1,19 @@
 import asyncio
+import concurrent.futures
+import os
+import tempfile
+import threading
+import time
 import unittest
 
 import udon.asynchronous
 
 
+def _write_pid(params):
+    with open(params["path"], "a") as fp:
+        fp.write("%d\n" % os.getpid())
+
+
 class TestThreadlet(unittest.TestCase):
 
     def test_none(self):
@@ -85,3 +95,185 @@ class TestThreadlet(unittest.TestCase):
         thread.start(_main)
         thread.join()
         self.assertEqual(seen, ["foo", "bar", "baz", "foo"])
+
+    def test_schedule_order(self):
+        seen = []
+        thread = udon.asynchronous.Threadlet()
+        tasks = [ thread.schedule(lambda i = i: seen.append(i), delay = .01 * (i % 5))
+                  for i in range(20) ]
+        tasks[3].unschedule()
+        tasks[7].schedule(.06)
+        self.assertFalse(tasks[3].is_scheduled())
+        self.assertTrue(tasks[7].is_scheduled())
+        thread.schedule(thread.stop, .1)
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [ 0, 5, 10, 15, 1, 6, 11, 16, 2, 12, 17, 8, 13, 18, 4, 9, 14, 19, 7 ])
+
+    def test_executor(self):
+        ticks = []
+        blocked = []
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+        thread = udon.asynchronous.Threadlet(executor = executor)
+
+        @thread.tasklet(period = .01)
+        def block(task):
+            blocked.append(threading.get_ident())
+            time.sleep(.1)
+
+        async def main(thread):
+            async def tick():
+                while True:
+                    ticks.append(time.time())
+                    await asyncio.sleep(.02)
+            ticker = asyncio.ensure_future(tick())
+            await thread.idle()
+            ticker.cancel()
+
+        thread.schedule(thread.stop, .25)
+        thread.start(main)
+        thread.join()
+        executor.shutdown()
+
+        # the event loop kept running, and the handler never overlaps itself.
+        self.assertGreater(len(ticks), 5)
+        self.assertIn(len(blocked), (2, 3))
+        self.assertNotIn(threading.get_ident(), blocked)
+        stats = thread.offload_stats()
+        self.assertEqual(stats['submitted'], len(blocked))
+        self.assertEqual(stats['max_pending'], 1)
+
+    def test_executor_calls_on_loop(self):
+        events = []
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+        thread = udon.asynchronous.Threadlet(executor = executor)
+        event = thread.event("ping")
+        scheduled = []
+        _scheduled_insert = thread._scheduled.insert
+        def insert(item, timestamp):
+            scheduled.append(threading.get_ident())
+            _scheduled_insert(item, timestamp)
+        thread._scheduled.insert = insert
+
+        @thread.tasklet()
+        def handler(task):
+            event.trigger()
+            task.schedule(.05)
+            thread.signal("done")
+
+        async def main(thread):
+            async for evt in thread:
+                events.append(evt["name"])
+                if evt["name"] == "done":
+                    thread.stop()
+
+        thread.start(main)
+        thread.join()
+        executor.shutdown()
+        self.assertEqual(events, [ "ping", "done" ])
+        self.assertEqual(set(scheduled), { threading.get_ident() })
+
+    def test_executor_inline(self):
+        seen = []
+        thread = udon.asynchronous.Threadlet(executor = concurrent.futures.ThreadPoolExecutor())
+
+        @thread.tasklet(executor = False)
+        def inline(task):
+            seen.append(threading.get_ident())
+
+        @thread.tasklet()
+        async def coroutine(task):
+            seen.append(threading.get_ident())
+
+        thread.schedule(thread.stop, .05)
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [ threading.get_ident() ] * 2)
+        self.assertEqual(thread.offload_stats()['submitted'], 0)
+
+    def test_process_executor(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "pids")
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers = 1)
+            thread = udon.asynchronous.Threadlet()
+            thread.tasklet(executor = executor, path = path)(_write_pid)
+            thread.schedule(thread.stop, .5)
+            thread.start()
+            thread.join()
+            executor.shutdown()
+            with open(path) as fp:
+                pids = fp.read().split()
+            self.assertEqual(len(pids), 1)
+            self.assertNotEqual(int(pids[0]), os.getpid())
+            self.assertEqual(thread.offload_stats()['completed'], 1)
+
+    def test_concurrency(self):
+        active = []
+        peak = []
+        done = []
+        thread = udon.asynchronous.Threadlet(concurrency = 2)
+
+        async def handler(task):
+            active.append(task)
+            peak.append(len(active))
+            await asyncio.sleep(.05)
+            active.remove(task)
+            done.append(task["index"])
+
+        for i in range(5):
+            thread.tasklet("task%d" % i, index = i)(handler)
+        self.assertTrue(thread["task0"].is_concurrent())
+        thread.tasklet("inline", concurrent = False, suspend = True)(handler)
+        self.assertFalse(thread["inline"].is_concurrent())
+        thread.schedule(thread.stop, .01)
+        t0 = time.time()
+        thread.start()
+        thread.join()
+
+        # stopping waits for the running tasklets.
+        self.assertEqual(sorted(done), list(range(5)))
+        self.assertEqual(max(peak), 2)
+        self.assertLess(time.time() - t0, .2)
+
+    def test_concurrency_no_overlap(self):
+        runs = []
+        active = []
+        thread = udon.asynchronous.Threadlet(concurrency = 4)
+
+        @thread.tasklet(period = .01)
+        async def slow(task):
+            self.assertEqual(active, [])
+            active.append(task)
+            runs.append(time.time())
+            await asyncio.sleep(.05)
+            active.remove(task)
+
+        # rescheduled while running: runs again once done.
+        thread.schedule(lambda: thread["slow"].schedule(), .02)
+        thread.schedule(thread.stop, .08)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(runs), 2)
+        self.assertGreaterEqual(runs[1] - runs[0], .05)
+
+    def test_concurrency_cancel(self):
+        cancelled = []
+        thread = udon.asynchronous.Threadlet(concurrency = 2)
+
+        @thread.tasklet()
+        async def forever(task):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(task)
+                raise
+
+        # cancelled while waiting for the running tasklets.
+        thread.schedule(thread.stop, .01)
+        thread.start()
+        loop = asyncio.get_event_loop()
+        loop.call_later(.05, thread._coro.cancel)
+        with self.assertRaises(asyncio.CancelledError):
+            thread.join()
+        loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(cancelled, [ thread["forever"] ])
@@ -0,0 +1,109 @@
+import gzip
+import os
+import tempfile
+import unittest
+
+import bottle
+
+import udon.content
+import udon.wsgi
+
+
+class TestEncoding(unittest.TestCase):
+
+    def test_parse_accept_encoding(self):
+        parse = udon.wsgi._parse_accept_encoding
+        self.assertEqual(parse(""), {})
+        self.assertEqual(parse("gzip, br"), { "gzip": 1.0, "br": 1.0 })
+        self.assertEqual(parse("GZIP;q=0.5, br ; q=0.8, identity;q=0"),
+                         { "gzip": 0.5, "br": 0.8, "identity": 0.0 })
+        self.assertEqual(parse("gzip;q=foo"), { "gzip": 0.0 })
+
+    def test_select_encoding(self):
+        select = udon.wsgi._select_encoding
+        self.assertEqual(select("", [ "br", "gzip" ]), None)
+        self.assertEqual(select("gzip", [ "br", "gzip" ]), "gzip")
+        self.assertEqual(select("gzip, br", [ "br", "gzip" ]), "br")
+        self.assertEqual(select("gzip, br;q=0.5", [ "br", "gzip" ]), "gzip")
+        self.assertEqual(select("*", [ "br", "gzip" ]), "br")
+        # explicitly refused
+        self.assertEqual(select("gzip;q=0", [ "gzip" ]), None)
+        self.assertEqual(select("*, gzip;q=0", [ "gzip" ]), None)
+        # identity preferred
+        self.assertEqual(select("identity, gzip;q=0.5", [ "gzip" ]), None)
+        self.assertEqual(select("identity;q=0.5, gzip", [ "gzip" ]), "gzip")
+
+    def test_variant_etag(self):
+        etag = udon.wsgi._variant_etag
+        self.assertEqual(etag(None, "gzip"), None)
+        self.assertEqual(etag('"abc"', "gzip"), '"abc-gzip"')
+        self.assertEqual(etag('W/"abc"', "br"), 'W/"abc-br"')
+        self.assertEqual(etag('abc', "gzip"), 'abc-gzip')
+
+
+class TestResponseContent(unittest.TestCase):
+
+    data = b"some text content\n" * 100
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "content")
+        with udon.content.writer(self.path, encodings = ("gzip",)) as fp:
+            fp.write_header("Content-Type", "text/plain")
+            fp.write_header("ETag", '"abc"')
+            fp.write(self.data)
+        with udon.content.reader(udon.content.variant_path(self.path, "gzip")) as fp:
+            self.encoded = fp.read()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def response(self, **environ):
+        environ.setdefault("REQUEST_METHOD", "GET")
+        request = bottle.BaseRequest(environ)
+        response = udon.wsgi.response_content(udon.content.reader(self.path), request = request)
+        body = response.body
+        if hasattr(body, "read"):
+            data = body.read()
+        else:
+            data = b"".join(body)
+        body.close()
+        return response, data
+
+    def test_identity(self):
+        response, data = self.response()
+        self.assertEqual(data, self.data)
+        self.assertEqual(response.get_header("Content-Encoding"), None)
+        self.assertEqual(response.get_header("Vary"), "Accept-Encoding")
+        self.assertEqual(response.get_header("ETag"), '"abc"')
+        self.assertEqual(response.get_header("Content-Length"), str(len(self.data)))
+
+        response, data = self.response(HTTP_ACCEPT_ENCODING = "gzip;q=0")
+        self.assertEqual(data, self.data)
+        self.assertEqual(response.get_header("Content-Encoding"), None)
+        self.assertEqual(response.get_header("Vary"), "Accept-Encoding")
+
+    def test_encoded(self):
+        response, data = self.response(HTTP_ACCEPT_ENCODING = "br;q=0.9, gzip")
+        self.assertEqual(gzip.decompress(data), self.data)
+        self.assertEqual(response.get_header("Content-Encoding"), "gzip")
+        self.assertEqual(response.get_header("Vary"), "Accept-Encoding")
+        self.assertEqual(response.get_header("ETag"), '"abc-gzip"')
+        self.assertEqual(response.get_header("Content-Length"), str(len(self.encoded)))
+
+    def test_encoded_range(self):
+        response, data = self.response(HTTP_ACCEPT_ENCODING = "gzip",
+                                       HTTP_RANGE = "bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(data, self.encoded[10:20])
+        self.assertEqual(response.get_header("Content-Encoding"), "gzip")
+        self.assertEqual(response.get_header("Content-Range"),
+                         "bytes 10-19/%d" % len(self.encoded))
+
+    def test_no_variants(self):
+        with udon.content.writer(self.path) as fp:
+            fp.write(self.data)
+        response, data = self.response(HTTP_ACCEPT_ENCODING = "gzip")
+        self.assertEqual(data, self.data)
+        self.assertEqual(response.get_header("Content-Encoding"), None)
+        self.assertEqual(response.get_header("Vary"), None)
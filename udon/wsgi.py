@@ -24,6 +24,8 @@ import time
 
 import bottle
 
+import udon.content
+
 
 def _logger(logger):
     return logger if logger is not None else logging.getLogger(__name__)
@@ -390,12 +392,14 @@ def response_json(value):
 
 class ResourceView:
 
-    def __init__(self, body, size, mtime, ctype = None, etag = None):
+    def __init__(self, body, size, mtime, ctype = None, etag = None, encoding = None, vary = None):
         self.body = body
         self.ctype = ctype if ctype is not None else 'application/octet-stream'
         self.size = size
         self.mtime = mtime
         self.etag = etag
+        self.encoding = encoding
+        self.vary = vary
 
 
 def response_view(view, request = None):
@@ -466,6 +470,10 @@ def response_view(view, request = None):
     if view.etag is not None:
         # XXX not if Range?
         response.set_header("ETag", view.etag)
+    if view.encoding is not None:
+        response.set_header("Content-Encoding", view.encoding)
+    if view.vary is not None:
+        response.set_header("Vary", view.vary)
 
     if request.method == "HEAD":
         response.set_header("Content-Length", view.size)
@@ -502,14 +510,76 @@ def response_file(path, ctype = None, etag = None):
     return response_view(view)
 
 
-def response_content(fp):
+def _parse_accept_encoding(value):
+    accepted = {}
+    for part in value.split(","):
+        params = part.split(";")
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        qvalue = 1.0
+        for param in params[1:]:
+            key, _, val = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    qvalue = float(val)
+                except ValueError:
+                    qvalue = 0.0
+        accepted[coding] = qvalue
+    return accepted
+
+
+def _select_encoding(value, encodings):
+    accepted = _parse_accept_encoding(value)
+    default = accepted.get("*", 0.0)
+    best, best_qvalue = None, 0.0
+    for encoding in encodings:
+        qvalue = accepted.get(encoding, default)
+        if qvalue > best_qvalue:
+            best, best_qvalue = encoding, qvalue
+    if accepted.get("identity", 0.0) > best_qvalue:
+        return None
+    return best
+
+
+def _variant_etag(etag, encoding):
+    if etag is None:
+        return None
+    if etag.endswith('"'):
+        return '%s-%s"' % (etag[:-1], encoding)
+    return '%s-%s' % (etag, encoding)
+
+
+def response_content(fp, request = None):
+    if request is None:
+        request = bottle.request
+
     headers = { key: val for key, val in fp.info.headers }
+    etag = headers.get('ETag')
+    encoding = vary = None
+
+    variants = udon.content.variants(fp)
+    if variants:
+        vary = "Accept-Encoding"
+        encoding = _select_encoding(request.environ.get('HTTP_ACCEPT_ENCODING', ''), variants)
+    if encoding is not None:
+        try:
+            vfp = udon.content.variant_reader(fp, encoding)
+        except KeyError:
+            encoding = None
+        else:
+            fp.close()
+            fp = vfp
+            etag = _variant_etag(etag, encoding)
+
     view = ResourceView(fp,
                         fp.info.size,
                         fp.info.timestamp,
                         ctype = headers.get("Content-Type"),
-                        etag = headers.get('ETag'))
-    return response_view(view)
+                        etag = etag,
+                        encoding = encoding,
+                        vary = vary)
+    return response_view(view, request = request)
 
 
 def response_request(req):